@@ -108,15 +108,26 @@ def execute() -> None:
 
     build_dir = tempfile.mkdtemp("azure-slurm")
 
-    def _add(name: str, path: Optional[str] = None, mode: Optional[int] = None) -> None:
+    def _add(
+        name: str,
+        path: Optional[str] = None,
+        mode: Optional[int] = None,
+        keep_mode: bool = False,
+    ) -> None:
         path = path or name
         tarinfo = tarfile.TarInfo("azure-slurm/" + name)
-        tarinfo.size = os.path.getsize(path)
-        tarinfo.mtime = int(os.path.getmtime(path))
-        if mode:
+        # one stat for size, mtime and (optionally) mode
+        st = os.stat(path)
+        tarinfo.size = st.st_size
+        tarinfo.mtime = int(st.st_mtime)
+        if keep_mode:
+            tarinfo.mode = st.st_mode & 0o7777
+        elif mode:
             tarinfo.mode = mode
 
-        with open(path, "rb") as fr:
+        # tarfile copies members in small chunks, so let the file object
+        # itself read ahead 1MB at a time
+        with open(path, "rb", buffering=1 << 20) as fr:
             tf.addfile(tarinfo, fr)
 
     packages = []
@@ -152,7 +163,7 @@ def execute() -> None:
         path = os.path.join(build_dir, fil)
         _add("packages/" + fil, path)
 
-    _add("install.sh", "install.sh", mode=os.stat("install.sh")[0])
+    _add("install.sh", "install.sh", keep_mode=True)
     _add("sbin/resume_fail_program.sh", "sbin/resume_fail_program.sh")
     _add("sbin/prolog.sh", "sbin/prolog.sh")
     _add("sbin/resume_program.sh", "sbin/resume_program.sh")
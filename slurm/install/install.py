@@ -1,39 +1,72 @@
-import argparse
+import collections
+import errno
+import functools
 import json
 import logging
-import logging.config
 import os
 import re
 import subprocess
 import sys
 import installlib as ilib
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import argparse
 
 # Legacy: used for connecting to Azure MariaDB, which is deprecated.
 LOCAL_AZURE_CA_PEM = "AzureCA.pem"
 
+_UNSAFE_NAME_CHARS = re.compile("[^a-zA-Z0-9-]")
+_FEATURE_RE = re.compile(r"(?i)\bfeature=")
+
 
 class InstallSettings:
+    __slots__ = (
+        "config",
+        "autoscale_dir",
+        "cyclecloud_cluster_name",
+        "slurm_cluster_name",
+        "slurm_db_cluster_name",
+        "node_name",
+        "node_name_lower",
+        "hostname",
+        "ipv4",
+        "slurmver",
+        "vm_size",
+        "slurm_user",
+        "slurm_grp",
+        "slurm_uid",
+        "slurm_gid",
+        "munge_user",
+        "munge_grp",
+        "munge_uid",
+        "munge_gid",
+        "_accounting",
+        "disable_pmc",
+        "use_nodename_as_hostname",
+        "node_name_prefix",
+        "ensure_waagent_monitor_hostname",
+        "platform_family",
+        "mode",
+        "dynamic_config",
+        "max_node_count",
+        "secondary_scheduler_name",
+        "is_primary_scheduler",
+        "config_dir",
+        "ubuntu22_waagent_fix",
+        "pending_services",
+    )
+
     def __init__(self, config: Dict, platform_family: str, mode: str) -> None:
         self.config = config
 
-        if "slurm" not in config:
-            config["slurm"] = {}
-
-        if "accounting" not in config["slurm"]:
-            config["slurm"]["acccounting"] = {}
-
-        if "user" not in config["slurm"]:
-            config["slurm"]["user"] = {}
-
-        if "munge" not in config:
-            config["munge"] = {}
-
-        if "user" not in config["munge"]:
-            config["munge"]["user"] = {}
+        slurm_cfg: Dict = config.setdefault("slurm", {})
+        slurm_user_cfg: Dict = slurm_cfg.setdefault("user", {})
+        acct_cfg: Dict = slurm_cfg.setdefault("accounting", {})
+        munge_user_cfg: Dict = config.setdefault("munge", {}).setdefault("user", {})
 
         self.autoscale_dir = (
-            config["slurm"].get("autoscale_dir") or "/opt/azurehpc/slurm"
+            slurm_cfg.get("autoscale_dir") or "/opt/azurehpc/slurm"
         )
         self.cyclecloud_cluster_name = config["cluster_name"]
         # We use a "safe" form of the CycleCloud ClusterName
@@ -49,79 +82,92 @@ class InstallSettings:
         # For now we use a second sanitized cluster name that derives from the escaped cluster name
         # but converts all hyphens to underscores.
         self.slurm_cluster_name = _escape(self.cyclecloud_cluster_name)
-        self.slurm_db_cluster_name = re.sub(r'-', '_', self.slurm_cluster_name)
+        self.slurm_db_cluster_name = self.slurm_cluster_name.replace("-", "_")
 
         self.node_name = config["node_name"]
+        self.node_name_lower = self.node_name.lower()
         self.hostname = config["hostname"]
         self.ipv4 = config["ipaddress"]
-        self.slurmver = config["slurm"]["version"]
+        self.slurmver = slurm_cfg["version"]
         self.vm_size = config["azure"]["metadata"]["compute"]["vmSize"]
 
-        self.slurm_user: str = config["slurm"]["user"].get("name") or "slurm"
-        self.slurm_grp: str = config["slurm"]["user"].get("group") or "slurm"
-        self.slurm_uid: str = config["slurm"]["user"].get("uid") or "11100"
-        self.slurm_gid: str = config["slurm"]["user"].get("gid") or "11100"
-
-        self.munge_user: str = config["munge"]["user"].get("name") or "munge"
-        self.munge_grp: str = config["munge"]["user"].get("group") or "munge"
-        self.munge_uid: str = config["munge"]["user"].get("uid") or "11101"
-        self.munge_gid: str = config["munge"]["user"].get("gid") or "11101"
-
-        self.acct_enabled: bool = config["slurm"]["accounting"].get("enabled", False)
-        self.acct_user: Optional[str] = config["slurm"]["accounting"].get("user")
-        self.acct_pass: Optional[str] = config["slurm"]["accounting"].get("password")
-        self.acct_url: Optional[str] = config["slurm"]["accounting"].get("url")
-        self.acct_cert_url: Optional[str] = config["slurm"]["accounting"].get("certificate_url")
-        self.acct_storageloc :Optional[str] = config["slurm"]["accounting"].get("storageloc")
-        self.disable_pmc = config["slurm"].get("disable_pmc") or False
-
-        self.use_nodename_as_hostname = config["slurm"].get(
+        self.slurm_user: str = slurm_user_cfg.get("name") or "slurm"
+        self.slurm_grp: str = slurm_user_cfg.get("group") or "slurm"
+        self.slurm_uid: str = slurm_user_cfg.get("uid") or "11100"
+        self.slurm_gid: str = slurm_user_cfg.get("gid") or "11100"
+
+        self.munge_user: str = munge_user_cfg.get("name") or "munge"
+        self.munge_grp: str = munge_user_cfg.get("group") or "munge"
+        self.munge_uid: str = munge_user_cfg.get("uid") or "11101"
+        self.munge_gid: str = munge_user_cfg.get("gid") or "11101"
+
+        # the acct_* properties are only read on the scheduler
+        self._accounting: Dict = acct_cfg
+        self.disable_pmc = slurm_cfg.get("disable_pmc") or False
+
+        self.use_nodename_as_hostname = slurm_cfg.get(
             "use_nodename_as_hostname", False
         )
-        self.node_name_prefix = config["slurm"].get("node_prefix")
+        self.node_name_prefix = slurm_cfg.get("node_prefix")
         if self.node_name_prefix:
-            self.node_name_prefix = re.sub(
-                "[^a-zA-Z0-9-]", "-", self.node_name_prefix
-            ).lower()
+            self.node_name_prefix = _escape(self.node_name_prefix)
 
-        self.ensure_waagent_monitor_hostname = config["slurm"].get(
+        self.ensure_waagent_monitor_hostname = slurm_cfg.get(
             "ensure_waagent_monitor_hostname", True
         )
 
         self.platform_family = platform_family
         self.mode = mode
 
-        self.dynamic_config = config["slurm"].get("dynamic_config")
+        self.dynamic_config = slurm_cfg.get("dynamic_config")
         if self.dynamic_config:
             self.dynamic_config = _inject_vm_size(self.dynamic_config, self.vm_size)
         self.dynamic_config
 
-        self.max_node_count = int(config["slurm"].get("max_node_count", 10000))
+        self.max_node_count = int(slurm_cfg.get("max_node_count", 10000))
 
-        self.additonal_slurm_config = (
-            config["slurm"].get("additional", {}).get("config")
-        )
-
-        self.secondary_scheduler_name = config["slurm"].get("secondary_scheduler_name")
-        self.is_primary_scheduler = config["slurm"].get("is_primary_scheduler", self.mode == "scheduler")
+        self.secondary_scheduler_name = slurm_cfg.get("secondary_scheduler_name")
+        self.is_primary_scheduler = slurm_cfg.get("is_primary_scheduler", self.mode == "scheduler")
         self.config_dir = f"/sched/{self.slurm_cluster_name}"
         # Leave the ability to disable this.
-        self.ubuntu22_waagent_fix = config["slurm"].get("ubuntu22_waagent_fix", True)
+        self.ubuntu22_waagent_fix = slurm_cfg.get("ubuntu22_waagent_fix", True)
+        # services to enable with a single systemctl call at the end of main()
+        self.pending_services: List[str] = []
+
+    @property
+    def acct_enabled(self) -> bool:
+        return self._accounting.get("enabled", False)
+
+    @property
+    def acct_user(self) -> Optional[str]:
+        return self._accounting.get("user")
+
+    @property
+    def acct_pass(self) -> Optional[str]:
+        return self._accounting.get("password")
+
+    @property
+    def acct_url(self) -> Optional[str]:
+        return self._accounting.get("url")
+
+    @property
+    def acct_cert_url(self) -> Optional[str]:
+        return self._accounting.get("certificate_url")
+
+    @property
+    def acct_storageloc(self) -> Optional[str]:
+        return self._accounting.get("storageloc")
+
+    @property
+    def additonal_slurm_config(self) -> Optional[str]:
+        return self.config["slurm"].get("additional", {}).get("config")
 
 
 def _inject_vm_size(dynamic_config: str, vm_size: str) -> str:
-    lc = dynamic_config.lower()
-    if "feature=" not in lc:
+    if not _FEATURE_RE.search(dynamic_config):
         logging.warning("Dynamic config is specified but no 'Feature={some_flag}' is set under slurm.dynamic_config.")
         return dynamic_config
-    else:
-        ret = []
-        for tok in dynamic_config.split():
-            if tok.lower().startswith("feature="):
-                ret.append(f"Feature={vm_size},{tok[len('Feature='):]}")
-            else:
-                ret.append(tok)
-        return " ".join(ret)
+    return _FEATURE_RE.sub(f"Feature={vm_size},", dynamic_config)
 
 def setup_config_dir(s: InstallSettings) -> None:
 
@@ -129,8 +175,10 @@ def setup_config_dir(s: InstallSettings) -> None:
     if s.is_primary_scheduler:
         ilib.directory(s.config_dir, owner="root", group="root", mode=755)
 
+
+@functools.lru_cache(maxsize=128)
 def _escape(s: str) -> str:
-    return re.sub("[^a-zA-Z0-9-]", "-", s).lower()
+    return _UNSAFE_NAME_CHARS.sub("-", s).lower()
 
 
 def setup_users(s: InstallSettings) -> None:
@@ -157,85 +205,153 @@ def setup_users(s: InstallSettings) -> None:
 
 
 def run_installer(s: InstallSettings, path: str, mode: str) -> None:
-    subprocess.check_call([path, mode, s.slurmver, str(s.disable_pmc)])
+    cmd = [path, mode, s.slurmver, str(s.disable_pmc)]
+    # echo the installer's output as before, and also keep it in our log.
+    # The tail is attached to the error if the installer fails.
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8",
+        errors="replace",
+        close_fds=False,
+    )
+    tail: Deque[str] = collections.deque(maxlen=50)
+    assert proc.stdout
+    with proc.stdout:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            line = line.rstrip()
+            logging.info(line)
+            tail.append(line)
+    returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output="\n".join(tail))
 
 
 def fix_permissions(s: InstallSettings) -> None:
+    slurm_owner: Dict[str, Any] = {"owner": s.slurm_user, "group": s.slurm_grp}
+    munge_owner: Dict[str, Any] = {"owner": s.munge_user, "group": s.munge_grp}
     # Fix munge permissions and create key
-    ilib.directory(
-        "/var/lib/munge",
-        owner=s.munge_user,
-        group=s.munge_grp,
-        mode=711,
-        recursive=True,
+    ilib.directories(
+        [
+            (
+                "/var/lib/munge",
+                dict(mode=711, recursive=True, **munge_owner),
+            ),
+            (
+                "/var/log/munge",
+                dict(owner="root", group="root", mode=700, recursive=True),
+            ),
+            (
+                "/run/munge",
+                dict(mode=755, recursive=True, **munge_owner),
+            ),
+            (
+                f"{s.config_dir}/munge",
+                dict(mode=700, **munge_owner),
+            ),
+        ]
     )
 
-    ilib.directory(
-        "/var/log/munge", owner="root", group="root", mode=700, recursive=True
-    )
+    # add slurm to cyclecloud so it has access to jetpack / userdata
+    if os.path.exists("/opt/cycle/jetpack"):
+        ilib.group_members("cyclecloud", members=[s.slurm_user], append=True)
 
-    ilib.directory(
-        "/run/munge", owner=s.munge_user, group=s.munge_grp, mode=755, recursive=True
+    ilib.directories(
+        [
+            ("/var/spool/slurmd", slurm_owner),
+            ("/var/log/slurmd", slurm_owner),
+            ("/var/log/slurmctld", slurm_owner),
+        ]
     )
 
-    ilib.directory(f"{s.config_dir}/munge", owner=s.munge_user, group=s.munge_grp, mode=700)
 
-    # Set up slurm
-    ilib.user(s.slurm_user, comment="User to run slurmctld", shell="/bin/false")
+# errnos from os.link on filesystems without hard link support
+_NO_HARDLINK_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP}
 
-    # add slurm to cyclecloud so it has access to jetpack / userdata
-    if os.path.exists("/opt/cycle/jetpack"):
-        ilib.group_members("cyclecloud", members=[s.slurm_user], append=True)
 
-    ilib.directory("/var/spool/slurmd", owner=s.slurm_user, group=s.slurm_grp)
+def _publish_munge_key(s: InstallSettings, key: bytes) -> None:
+    """
+    {s.config_dir} is usually an NFS mount shared with the other nodes, so the
+    key is written and fsync'd under a temporary name, then linked (or renamed,
+    where hard links are unsupported) into place.
+    Readers will either see no key or the complete key, never a partial one.
+    """
+    dest = f"{s.config_dir}/munge.key"
+    tmp_dest = f"{s.config_dir}/.munge.key.tmp"
+    if os.path.exists(tmp_dest):
+        # left behind by an interrupted install
+        os.remove(tmp_dest)
+
+    logging.info(f"Creating {dest}")
+    try:
+        fd = os.open(tmp_dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.write(fd, key)
+            # the mode passed to os.open is subject to the umask
+            os.fchmod(fd, 0o600)
+            os.fchown(
+                fd,
+                ilib.getpwnam(s.munge_user).pw_uid,
+                ilib.getgrnam(s.munge_grp).gr_gid,
+            )
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        try:
+            # unlike rename, link refuses to replace an existing file, so if another
+            # node published a key in the meantime we keep theirs.
+            os.link(tmp_dest, dest)
+        except FileExistsError:
+            logging.warning(f"{dest} was created concurrently, keeping the existing key")
+        except OSError as e:
+            if e.errno not in _NO_HARDLINK_ERRNOS:
+                raise
+            # e.g. SMB/Azure Files or blobfuse mounts. Fall back to a plain
+            # rename, which can only race with a node publishing at the same time.
+            if os.path.exists(dest):
+                logging.warning(f"{dest} was created concurrently, keeping the existing key")
+            else:
+                os.replace(tmp_dest, dest)
+    finally:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
 
-    ilib.directory("/var/log/slurmd", owner=s.slurm_user, group=s.slurm_grp)
-    ilib.directory("/var/log/slurmctld", owner=s.slurm_user, group=s.slurm_grp)
+    # make the new directory entry itself durable
+    dir_fd = os.open(s.config_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
 def munge_key(s: InstallSettings) -> None:
+    munge_owner: Dict[str, Any] = {"owner": s.munge_user, "group": s.munge_grp}
 
-    ilib.directory(
-        "/etc/munge", owner=s.munge_user, group=s.munge_grp, mode=700, recursive=True
-    )
+    ilib.directory("/etc/munge", **munge_owner, mode=700, recursive=True)
 
     if s.mode == "scheduler" and not os.path.exists(f"{s.config_dir}/munge.key"):
         # TODO only should do this on the primary
         # we should skip this for secondary HA nodes
-        with open("/dev/urandom", "rb") as fr:
-            buf = bytes()
-            while len(buf) < 1024:
-                buf = buf + fr.read(1024 - len(buf))
-        ilib.file(
-            f"{s.config_dir}/munge.key",
-            content=buf,
-            owner=s.munge_user,
-            group=s.munge_grp,
-            mode=700,
-        )
+        _publish_munge_key(s, os.urandom(1024))
 
     ilib.copy_file(
         f"{s.config_dir}/munge.key",
         "/etc/munge/munge.key",
-        owner=s.munge_user,
-        group=s.munge_grp,
+        **munge_owner,
         mode="0600",
     )
 
 
-def accounting(s: InstallSettings) -> None:
-    if s.mode != "scheduler":
-        return
-    if s.is_primary_scheduler:
-        _accounting_primary(s)
-    _accounting_all(s)
-
-
 def _accounting_primary(s: InstallSettings) -> None:
     """
     Only the primary scheduler should be creating files under
     {s.config_dir} for accounting.
     """
+    slurm_owner: Dict[str, Any] = {"owner": s.slurm_user, "group": s.slurm_grp}
 
     if s.secondary_scheduler_name:
         secondary_scheduler = ilib.await_node_hostname(
@@ -245,16 +361,14 @@ def _accounting_primary(s: InstallSettings) -> None:
         logging.info("slurm.accounting.enabled is false, skipping this step.")
         ilib.file(
             f"{s.config_dir}/accounting.conf",
-            owner=s.slurm_user,
-            group=s.slurm_grp,
+            **slurm_owner,
             content="AccountingStorageType=accounting_storage/none",
         )
         return
 
     ilib.file(
         f"{s.config_dir}/accounting.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
+        **slurm_owner,
         content=f"""
 AccountingStorageType=accounting_storage/slurmdbd
 AccountingStorageHost={s.hostname}
@@ -265,33 +379,24 @@ AccountingStorageTRES=gres/gpu
     # Previously this was required when connecting to any Azure MariaDB instance.
     # Which is why we shipped with LOCAL_AZURE_CA_PEM.
     if s.acct_cert_url and s.acct_cert_url != LOCAL_AZURE_CA_PEM:
-        logging.info(f"Downloading {s.acct_cert_url} to {s.config_dir}/AzureCA.pem")
-        subprocess.check_call(
-            [
-                "wget",
-                "-O",
-                f"{s.config_dir}/AzureCA.pem",
-                s.acct_cert_url,
-            ]
-        )
-        ilib.chown(
-            f"{s.config_dir}/AzureCA.pem", owner=s.slurm_user, group=s.slurm_grp
+        ilib.download(
+            s.acct_cert_url,
+            f"{s.config_dir}/AzureCA.pem",
+            **slurm_owner,
+            mode="0600",
         )
-        ilib.chmod(f"{s.config_dir}/AzureCA.pem", mode="0600")
     elif s.acct_cert_url and s.acct_cert_url == LOCAL_AZURE_CA_PEM:
         ilib.copy_file(
             LOCAL_AZURE_CA_PEM,
             f"{s.config_dir}/AzureCA.pem",
-            owner=s.slurm_user,
-            group=s.slurm_grp,
+            **slurm_owner,
             mode="0600",
         )
 
     # Configure slurmdbd.conf
     ilib.template(
         f"{s.config_dir}/slurmdbd.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
+        **slurm_owner,
         source="templates/slurmdbd.conf.template",
         mode=600,
         variables={
@@ -324,6 +429,7 @@ def _accounting_all(s: InstallSettings) -> None:
     """
     Perform linking and enabling of slurmdbd
     """
+    slurm_owner: Dict[str, Any] = {"owner": s.slurm_user, "group": s.slurm_grp}
     # This used to be required for all installations, but it is
     # now optional, so only create the link if required.
     original_azure_ca_pem = f"{s.config_dir}/AzureCA.pem"
@@ -331,26 +437,28 @@ def _accounting_all(s: InstallSettings) -> None:
         ilib.link(
             f"{s.config_dir}/AzureCA.pem",
             "/etc/slurm/AzureCA.pem",
-            owner=s.slurm_user,
-            group=s.slurm_grp,
+            **slurm_owner,
         )
 
     # Link shared slurmdbd.conf to real config file location
     ilib.link(
         f"{s.config_dir}/slurmdbd.conf",
         "/etc/slurm/slurmdbd.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
+        **slurm_owner,
     )
 
-    ilib.enable_service("slurmdbd")
+    s.pending_services.append("slurmdbd")
 
 
 def complete_install(s: InstallSettings) -> None:
     if s.mode == "scheduler":
+        # write everything under {s.config_dir}, including the accounting
+        # config, before anything is linked into /etc/slurm.
         if s.is_primary_scheduler:
             _complete_install_primary(s)
+            _accounting_primary(s)
         _complete_install_all(s)
+        _accounting_all(s)
     else:
         _complete_install_all(s)
 
@@ -359,6 +467,7 @@ def _complete_install_primary(s: InstallSettings) -> None:
     """
     Only the primary scheduler should be creating files under {s.config_dir}.
     """
+    slurm_owner: Dict[str, Any] = {"owner": s.slurm_user, "group": s.slurm_grp}
     assert s.is_primary_scheduler
     secondary_scheduler = None
     if s.secondary_scheduler_name:
@@ -366,23 +475,36 @@ def _complete_install_primary(s: InstallSettings) -> None:
             s.config, s.secondary_scheduler_name
         )
 
-    state_save_location = f"{s.config_dir}/spool/slurmctld"
+    # {s.config_dir} is usually on NFS, so list it once rather than
+    # stat'ing each of the files below individually.
+    existing = set(os.listdir(s.config_dir))
 
-    if not os.path.exists(state_save_location):
-        ilib.directory(state_save_location, owner=s.slurm_user, group=s.slurm_grp)
+    state_save_location = f"{s.config_dir}/spool/slurmctld"
 
-    ilib.template(
-        f"{s.config_dir}/slurm.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-        mode="0644",
-        source="templates/slurm.conf.template",
-        variables={
-            "slurmctldhost": f"{s.hostname}({s.ipv4})",
-            "cluster_name": s.slurm_cluster_name,
-            "max_node_count": s.max_node_count,
-            "state_save_location": state_save_location,
-        },
+    if "spool" not in existing or not os.path.exists(state_save_location):
+        ilib.directory(state_save_location, **slurm_owner)
+
+    ilib.templates(
+        [
+            (
+                f"{s.config_dir}/slurm.conf",
+                dict(
+                    source="templates/slurm.conf.template",
+                    mode="0644",
+                    variables={
+                        "slurmctldhost": f"{s.hostname}({s.ipv4})",
+                        "cluster_name": s.slurm_cluster_name,
+                        "max_node_count": s.max_node_count,
+                        "state_save_location": state_save_location,
+                    },
+                    **slurm_owner,
+                ),
+            ),
+            (
+                f"{s.config_dir}/cgroup.conf",
+                dict(source="templates/cgroup.conf.template", mode="0644", **slurm_owner),
+            ),
+        ]
     )
 
     if secondary_scheduler:
@@ -399,117 +521,63 @@ def _complete_install_primary(s: InstallSettings) -> None:
             comment_prefix="\n# Additional config from CycleCloud -",
         )
 
-    ilib.template(
-        f"{s.config_dir}/cgroup.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-        source=f"templates/cgroup.conf.template",
-        mode="0644",
+    placeholders = {
+        "azure.conf": "",
+        "keep_alive.conf": "# Do not edit this file. It is managed by azslurm",
+        "gres.conf": "",
+    }
+    ilib.files(
+        [
+            (
+                f"{s.config_dir}/{name}",
+                dict(content=content, mode="0644", **slurm_owner),
+            )
+            for name, content in placeholders.items()
+            if name not in existing
+        ]
     )
 
-    if not os.path.exists(f"{s.config_dir}/azure.conf"):
-        ilib.file(
-            f"{s.config_dir}/azure.conf",
-            owner=s.slurm_user,
-            group=s.slurm_grp,
-            mode="0644",
-            content="",
-        )
-
-    if not os.path.exists(f"{s.config_dir}/keep_alive.conf"):
-        ilib.file(
-            f"{s.config_dir}/keep_alive.conf",
-            owner=s.slurm_user,
-            group=s.slurm_grp,
-            mode="0644",
-            content="# Do not edit this file. It is managed by azslurm",
-        )
-
-    if not os.path.exists(f"{s.config_dir}/gres.conf"):
-        ilib.file(
-            f"{s.config_dir}/gres.conf",
-            owner=s.slurm_user,
-            group=s.slurm_grp,
-            mode="0644",
-            content="",
-        )
-
 def _complete_install_all(s: InstallSettings) -> None:
-    ilib.link(
-        f"{s.config_dir}/gres.conf",
-        "/etc/slurm/gres.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-    )
-
-    ilib.link(
-        f"{s.config_dir}/slurm.conf",
-        "/etc/slurm/slurm.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-    )
-
-    ilib.link(
-        f"{s.config_dir}/cgroup.conf",
-        "/etc/slurm/cgroup.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-    )
-
-    ilib.link(
-        f"{s.config_dir}/azure.conf",
-        "/etc/slurm/azure.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-    )
-
-    ilib.link(
-        f"{s.config_dir}/keep_alive.conf",
-        "/etc/slurm/keep_alive.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
-    )
-
-    # Link the accounting.conf regardless
-    ilib.link(
-        f"{s.config_dir}/accounting.conf",
-        "/etc/slurm/accounting.conf",
-        owner=s.slurm_user,
-        group=s.slurm_grp,
+    slurm_owner: Dict[str, Any] = {"owner": s.slurm_user, "group": s.slurm_grp}
+    ilib.links(
+        [
+            (f"{s.config_dir}/gres.conf", "/etc/slurm/gres.conf"),
+            (f"{s.config_dir}/slurm.conf", "/etc/slurm/slurm.conf"),
+            (f"{s.config_dir}/cgroup.conf", "/etc/slurm/cgroup.conf"),
+            (f"{s.config_dir}/azure.conf", "/etc/slurm/azure.conf"),
+            (f"{s.config_dir}/keep_alive.conf", "/etc/slurm/keep_alive.conf"),
+            # Link the accounting.conf regardless
+            (f"{s.config_dir}/accounting.conf", "/etc/slurm/accounting.conf"),
+        ],
+        **slurm_owner,
     )
 
-    ilib.template(
-        "/etc/security/limits.d/slurm-limits.conf",
-        source="templates/slurm-limits.conf",
-        owner="root",
-        group="root",
-        mode=644,
-    )
-
-    ilib.directory(
-        "/etc/systemd/system/slurmctld.service.d", owner="root", group="root", mode=755
-    )
-
-    ilib.template(
-        "/etc/systemd/system/slurmctld.service.d/override.conf",
-        source="templates/slurmctld.override",
-        owner="root",
-        group="root",
-        mode=644,
-    )
-
-    ilib.template(
-        "/etc/slurm/job_submit.lua.azurehpc.example",
-        source="templates/job_submit.lua",
-        owner="root",
-        group="root",
-        mode=644,
+    root_owner: Dict[str, Any] = {"owner": "root", "group": "root"}
+    # the override.conf below needs its directory first
+    ilib.directory("/etc/systemd/system/slurmctld.service.d", **root_owner, mode=755)
+
+    ilib.templates(
+        [
+            (
+                "/etc/security/limits.d/slurm-limits.conf",
+                dict(source="templates/slurm-limits.conf", mode=644, **root_owner),
+            ),
+            (
+                "/etc/systemd/system/slurmctld.service.d/override.conf",
+                dict(source="templates/slurmctld.override", mode=644, **root_owner),
+            ),
+            (
+                "/etc/slurm/job_submit.lua.azurehpc.example",
+                dict(source="templates/job_submit.lua", mode=644, **root_owner),
+            ),
+        ]
     )
 
     ilib.create_service("munged", user=s.munge_user, exec_start="/sbin/munged")
 
 
 def setup_slurmd(s: InstallSettings) -> None:
+    slurm_owner: Dict[str, Any] = {"owner": s.slurm_user, "group": s.slurm_grp}
     slurmd_config = f"SLURMD_OPTIONS=-b -N {s.node_name}"
     if s.dynamic_config:
         slurmd_config = f"SLURMD_OPTIONS={s.dynamic_config} -N {s.node_name}"
@@ -519,11 +587,10 @@ def setup_slurmd(s: InstallSettings) -> None:
     ilib.file(
         "/etc/sysconfig/slurmd" if s.platform_family == "rhel" else "/etc/default/slurmd",
         content=slurmd_config,
-        owner=s.slurm_user,
-        group=s.slurm_grp,
+        **slurm_owner,
         mode="0700",
     )
-    ilib.enable_service("slurmd")
+    s.pending_services.append("slurmd")
 
 
 def set_hostname(s: InstallSettings) -> None:
@@ -533,8 +600,12 @@ def set_hostname(s: InstallSettings) -> None:
     if s.is_primary_scheduler:
         return
 
-    new_hostname = s.node_name.lower()
-    if s.mode != "execute" and not new_hostname.startswith(s.node_name_prefix):
+    new_hostname = s.node_name_lower
+    if (
+        s.mode != "execute"
+        and s.node_name_prefix
+        and not new_hostname.startswith(s.node_name_prefix)
+    ):
         new_hostname = f"{s.node_name_prefix}{new_hostname}"
 
     ilib.set_hostname(
@@ -550,26 +621,71 @@ def set_hostname(s: InstallSettings) -> None:
 def _is_at_least_ubuntu22() -> bool:
     if not os.path.exists("/etc/os-release"):
         return False
-    lsb_rel = {}
+    os_id = version_id = None
     with open("/etc/os-release") as fr:
         for line in fr:
-            line = line.strip()
-            if not line:
+            key, sep, val = line.partition("=")
+            if not sep:
                 continue
-            if "=" not in line:
+            key = key.strip().upper()
+            if key == "ID":
+                os_id = val.strip().strip('"').strip().lower()
+            elif key == "VERSION_ID":
+                version_id = val.strip().strip('"').strip().lower()
+            else:
                 continue
-            key, val = line.split("=", 1)
-            lsb_rel[key.strip().upper()] = val.strip('"').strip().lower()
+            if os_id is not None and version_id is not None:
+                break
+
+    return os_id == "ubuntu" and (version_id or "") >= "22.04"
+
+
+def return_to_idle(s: InstallSettings) -> None:
+    # TODO create a rotate log
+    ilib.cron(
+        "return_to_idle",
+        minute="*/5",
+        command=f"{s.autoscale_dir}/return_to_idle.sh 1>&2 >> {s.autoscale_dir}/logs/return_to_idle.log",
+    )
+
+
+# mode specific steps, run in order after the common steps in main()
+_MODE_STEPS: Dict[str, Tuple[Callable[[InstallSettings], None], ...]] = {
+    "scheduler": (complete_install, return_to_idle, set_hostname),
+    "execute": (complete_install, set_hostname, setup_slurmd),
+    "login": (complete_install, set_hostname),
+}
 
-    if lsb_rel.get("ID") == "ubuntu" and lsb_rel.get("VERSION_ID", "") >= "22.04":
-        return True
-    
-    return False
+
+def _jetpack_node_json() -> str:
+    cyclecloud_home = os.getenv("CYCLECLOUD_HOME") or "/opt/cycle/jetpack"
+    return os.path.join(cyclecloud_home, "config", "node.json")
 
 
 def _load_config(bootstrap_config: str) -> Dict:
     if bootstrap_config == "jetpack":
-        config = json.loads(subprocess.check_output(["jetpack", "config", "--json"]))
+        # jetpack config --json just re-emits config/node.json, which the
+        # cluster-init scripts already pass in directly via --bootstrap-config.
+        # Read it ourselves rather than paying for jetpack's interpreter startup,
+        # but keep the command as a fallback in case the layout ever changes.
+        node_json = _jetpack_node_json()
+        if os.path.exists(node_json):
+            bootstrap_config = node_json
+
+    if bootstrap_config == "jetpack":
+        cmd = ["jetpack", "config", "--json"]
+        # parse straight off the pipe rather than buffering the whole output
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            assert proc.stdout
+            try:
+                config = json.load(proc.stdout)
+            except ValueError:
+                # report jetpack's failure rather than the empty output
+                if proc.wait() != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, cmd)
+                raise
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
     else:
         with open(bootstrap_config) as fr:
             config = json.load(fr)
@@ -581,10 +697,10 @@ def _load_config(bootstrap_config: str) -> Dict:
     return config
 
 
-def main() -> None:
-    # needed to set slurmctld only
-    if os.path.exists("install_logging.conf"):
-        logging.config.fileConfig("install_logging.conf")
+@functools.lru_cache(maxsize=1)
+def _parser() -> "argparse.ArgumentParser":
+    # argparse is only needed when run as a script, so import it lazily
+    import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -594,12 +710,27 @@ def main() -> None:
         "--mode", default="scheduler", choices=["scheduler", "execute", "login"]
     )
     parser.add_argument("--bootstrap-config", default="jetpack")
+    return parser
 
-    args = parser.parse_args()
+
+def main(argv: Optional[List[str]] = None) -> None:
+    # needed to set slurmctld only
+    if os.path.exists("install_logging.conf"):
+        import logging.config
+
+        logging.config.fileConfig("install_logging.conf")
+
+    args = _parser().parse_args(argv)
 
     if args.platform == "debian":
         args.platform = "ubuntu"
 
+    # resolve the platform installer up front so a bad install dir fails
+    # before we have created users or touched {config_dir}
+    installer_path = os.path.abspath(f"{args.platform}.sh")
+    if not os.path.isfile(installer_path):
+        raise RuntimeError(f"Platform installer {installer_path} does not exist!")
+
     config = _load_config(args.bootstrap_config)
     settings = InstallSettings(config, args.platform, args.mode)
 
@@ -613,26 +744,15 @@ def main() -> None:
     munge_key(settings)
 
     # runs either rhel.sh or ubuntu.sh to install the packages
-    run_installer(settings, os.path.abspath(f"{args.platform}.sh"), args.mode)
+    run_installer(settings, installer_path, args.mode)
 
     # various permissions fixes
     fix_permissions(settings)
 
-    complete_install(settings)
-
-    if settings.mode == "scheduler":
-        accounting(settings)
-        # TODO create a rotate log
-        ilib.cron(
-            "return_to_idle",
-            minute="*/5",
-            command=f"{settings.autoscale_dir}/return_to_idle.sh 1>&2 >> {settings.autoscale_dir}/logs/return_to_idle.log",
-        )
-
-    set_hostname(settings)
+    for step in _MODE_STEPS[settings.mode]:
+        step(settings)
 
-    if settings.mode == "execute":
-        setup_slurmd(settings)
+    ilib.enable_services(settings.pending_services)
 
 
 if __name__ == "__main__":
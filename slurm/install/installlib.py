@@ -1,22 +1,27 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import grp
 from hashlib import md5
 import json
 import logging
 import os
 import pwd
+import random
 import re
 import shutil
+import socket
 from ssl import SSLContext
 import ssl
+import stat
 import subprocess
-import tempfile
 from time import sleep as _sleep
 from datetime import datetime, timezone
 from types import TracebackType
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 import urllib
+import urllib.error
 import urllib.parse
 import urllib.request
 
@@ -65,6 +70,21 @@ def sleep(n: float) -> None:
     return _CLOCK.sleep(n)
 
 
+def _check_call(cmd: List[str]) -> None:
+    """
+    None of install's children need our fds (python creates them
+    non-inheritable anyway), so skip closing them in the child.
+    """
+    subprocess.check_call(cmd, close_fds=False)
+
+
+def _check_output(cmd: Union[str, List[str]]) -> bytes:
+    """
+    see _check_call
+    """
+    return subprocess.check_output(cmd, close_fds=False)
+
+
 def blob_download(filename: str, project: str, node: Dict) -> str:
 
     downloads_dir = node["blobs"].get("downloads", "/opt/azurehpc/blobs")
@@ -77,7 +97,7 @@ def blob_download(filename: str, project: str, node: Dict) -> str:
         # src = os.path.join(node["blobs"]["url"], filename)
         # shutil.copyfile(src=src, dst=dest)
     elif node["blobs"]["type"] == "jetpack":
-        subprocess.check_call(
+        _check_call(
             ["jetpack", "download", filename, f"--project={project}", dest]
         )
         return dest
@@ -85,15 +105,125 @@ def blob_download(filename: str, project: str, node: Dict) -> str:
         raise ConvergeError("Only blobs.type==simple or jetpack is valid at this time")
 
 
+def download(
+    url: str,
+    dest: str,
+    owner: Optional[str] = None,
+    group: Optional[str] = None,
+    mode: Optional[Union[str, int]] = None,
+    timeout: int = 30,
+    retries: int = 4,
+) -> None:
+    """
+    Streams url to dest in-process, rather than forking wget. Connection errors,
+    timeouts, 429s and 5XX responses are retried with exponential backoff, and
+    dest is only replaced once the whole response has been written - with its
+    owner, group and mode already set, as with file(). A partial download is
+    never left behind.
+    """
+    logging.info(f"Downloading {url} to {dest}")
+    context = ssl.create_default_context()
+    tmp_dest = dest + ".tmp"
+    try:
+        for attempt in range(retries + 1):
+            try:
+                with urllib.request.urlopen(url, timeout=timeout, context=context) as response:
+                    with open(tmp_dest, "wb") as fw:
+                        shutil.copyfileobj(response, fw, 1 << 16)
+                break
+            except OSError as e:
+                # URLError, HTTPError and socket.timeout are all OSErrors
+                is_client_error = (
+                    isinstance(e, urllib.error.HTTPError) and e.code < 500 and e.code != 429
+                )
+                if is_client_error or attempt >= retries:
+                    raise
+                delay = 2 ** attempt
+                logging.warning(
+                    f"Attempt {attempt + 1} to download {url} failed: {e}. Retrying in {delay} seconds"
+                )
+                sleep(delay)
+
+        chown(tmp_dest, owner, group)
+        chmod(tmp_dest, mode)
+        os.replace(tmp_dest, dest)
+    except BaseException:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+
+
 def link(
     src: str, dst: str, owner: Optional[str] = None, group: Optional[str] = None
 ) -> None:
-    if not os.path.islink(dst):
-        logging.info("Linking {dst} to {src}".format(**locals()))
+    # symlink(2) is already atomic, so just try it rather than probing first.
+    try:
         os.symlink(src, dst)
-        # chown(to, owner, group)
-    else:
+    except FileExistsError:
+        if not os.path.islink(dst):
+            raise
         logging.info("Link {dst} already exists".format(**locals()))
+        return
+
+    logging.info("Linking {dst} to {src}".format(**locals()))
+    if owner:
+        pwd_record = getpwnam(owner)
+        gid = getgrnam(group).gr_gid if group else pwd_record.pw_gid
+        # lchown - the target may not exist yet, and is not ours to chown anyway
+        os.lchown(dst, pwd_record.pw_uid, gid)
+
+
+@functools.lru_cache(maxsize=None)
+def getpwnam(user_name: str) -> pwd.struct_passwd:
+    """
+    Memoized pwd.getpwnam - on LDAP/SSSD backed nodes every lookup is a
+    round trip, and we look up the same handful of users over and over.
+    Missing users raise KeyError and are not cached.
+    """
+    return pwd.getpwnam(user_name)
+
+
+@functools.lru_cache(maxsize=None)
+def getgrnam(group_name: str) -> grp.struct_group:
+    """
+    Memoized grp.getgrnam, see getpwnam
+    """
+    return grp.getgrnam(group_name)
+
+
+def _exists(lookup: Callable[[str], Any], name: str) -> bool:
+    """
+    Point lookup rather than enumerating getpwall()/getgrall(), which on
+    LDAP/AD joined nodes walks the entire directory. Misses raise KeyError,
+    which lru_cache does not remember, so a user or group created afterwards
+    is still found.
+    """
+    try:
+        lookup(name)
+        return True
+    except KeyError:
+        return False
+
+
+def _concurrently(func: Callable[[Any], None], items: List[Any], max_workers: int = 4) -> None:
+    """
+    For independent filesystem operations that mostly wait on the (often NFS)
+    filesystem rather than the CPU.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results so any exception is re-raised here
+        list(executor.map(func, items))
+
+
+def links(
+    pairs: List[Tuple[str, str]],
+    owner: Optional[str] = None,
+    group: Optional[str] = None,
+) -> None:
+    """
+    Creates each (src, dst) symlink concurrently, all with the same owner and group.
+    """
+    _concurrently(lambda pair: link(pair[0], pair[1], owner=owner, group=group), pairs)
 
 
 def chown(
@@ -105,41 +235,66 @@ def chown(
     pwd_record = uid = gid = None
 
     if owner:
-        pwd_record = pwd.getpwnam(owner)
+        pwd_record = getpwnam(owner)
         uid = pwd_record.pw_uid
         gid = pwd_record.pw_gid
 
     if group:
-        gid = grp.getgrnam(group).gr_gid
+        gid = getgrnam(group).gr_gid
     elif pwd_record:
         group = pwd_record.pw_name
 
     if uid and gid:
         recursive_arg = "-R" if recursive else ""
-        logging.info(f"chown {recursive_arg} {dest} with {owner}({uid}):{group}({gid})")
-        os.chown(dest, uid=uid, gid=gid)
+        st = os.stat(dest)
+        if st.st_uid == uid and st.st_gid == gid:
+            logging.debug(f"{dest} is already owned by {owner}({uid}):{group}({gid})")
+        else:
+            logging.info(f"chown {recursive_arg} {dest} with {owner}({uid}):{group}({gid})")
+            os.chown(dest, uid=uid, gid=gid)
         if recursive and os.path.isdir(dest):
-            # TODO should probably use OS version
-            for fil in os.listdir(dest):
-                chown(os.path.join(dest, fil), owner, group, recursive=recursive)
+            _chown_tree(dest, uid, gid)
+
+
+def _chown_tree(top: str, uid: int, gid: int) -> None:
+    """
+    chowns everything below top in one walk, relative to each directory's fd.
+    Like chown -R, symlinks are chowned themselves and never followed.
+    """
+    for _, dirs, files, dir_fd in os.fwalk(top):
+        for name in dirs + files:
+            # on an already converged node nearly everything matches, and
+            # a stat is far cheaper than a chown (which also bumps ctime)
+            st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            if st.st_uid != uid or st.st_gid != gid:
+                os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
 
 
 def chmod(dest: str, mode: Optional[Union[str, int]], recursive: bool = False) -> None:
+    """
+    modes are given as octal digits, i.e. 700, 644 or "0600"
+    """
     if mode is not None:
-        # if isinstance(mode, str):
-        #     mode = int(mode)
-        logging.info(f"chmod {mode} {dest}")
-        if recursive:
-            cmd = ["chmod", "-R", str(mode), dest]
+        octal_mode = int(str(mode), 8)
+        if stat.S_IMODE(os.stat(dest).st_mode) == octal_mode:
+            logging.debug(f"{dest} already has mode {mode}")
         else:
-            cmd = ["chmod", str(mode), dest]
-        logging.info(" ".join(cmd))
-        subprocess.check_call(cmd)
-        # os.chmod(dest, mode)
+            logging.info(f"chmod {mode} {dest}")
+            os.chmod(dest, octal_mode)
+        if recursive and os.path.isdir(dest):
+            _chmod_tree(dest, octal_mode)
+
 
-        # if recursive and os.path.isdir(dest):
-        #     for fil in os.listdir(dest):
-        #         chmod(os.path.join(dest, fil), mode, recursive=recursive)
+def _chmod_tree(top: str, mode: int) -> None:
+    """
+    chmods everything below top, see _chown_tree. Like chmod -R, symlinks
+    are skipped - Linux has no mode on a symlink to change.
+    """
+    for _, dirs, files, dir_fd in os.fwalk(top):
+        for name in dirs + files:
+            st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            if not stat.S_ISLNK(st.st_mode) and stat.S_IMODE(st.st_mode) != mode:
+                os.chmod(name, mode, dir_fd=dir_fd)
 
 
 def copy_file(
@@ -157,13 +312,27 @@ def file(
     group: Optional[str] = None,
     mode: Optional[Union[str, int]] = None,
 ) -> None:
-    io_mode = "a" if isinstance(content, str) else "ab"
+    # "w", not "a" - a .tmp left behind by a failed run must not be appended to
+    io_mode = "w" if isinstance(content, str) else "wb"
     tmp_dest = dest + ".tmp"
     with open(tmp_dest, io_mode) as fw:
         fw.write(content)
+        fw.flush()
+        # durable before the rename, so services never see a partial file
+        os.fsync(fw.fileno())
     chown(tmp_dest, owner, group)
     chmod(tmp_dest, mode)
-    move(tmp_dest, dest)
+    logging.info(f"mv {tmp_dest} {dest}")
+    # tmp_dest is in the same directory, so this is a single atomic rename
+    os.replace(tmp_dest, dest)
+
+
+def files(entries: List[Tuple[str, Dict]]) -> None:
+    """
+    Writes independent files concurrently. Each entry is
+    (dest, file() kwargs), see directories
+    """
+    _concurrently(lambda f: file(f[0], **f[1]), entries)
 
 
 def append_file(dest: str, content: str, comment_prefix: str) -> None:
@@ -197,6 +366,23 @@ def cookbook_file(
     copy_file(full_source, dest, owner, group, mode)
 
 
+_TEMPLATE_CACHE: Dict[str, str] = {}
+
+
+def _read_template(source: str) -> str:
+    """
+    Template sources are shipped with the installer and never change
+    during a run, so each one is only read from disk once.
+    """
+    if source not in _TEMPLATE_CACHE:
+        if not os.path.exists(source):
+            raise ConvergeError(f"Template {source} does not exist!")
+
+        with open(source) as fr:
+            _TEMPLATE_CACHE[source] = fr.read()
+    return _TEMPLATE_CACHE[source]
+
+
 def template(
     dest: str,
     owner: str,
@@ -206,44 +392,60 @@ def template(
     variables: Optional[Dict] = None,
 ) -> None:
 
-    if os.path.exists(dest):
-        shutil.move(dest, f"{dest}.backup")
-
     variables = variables or {}
     if isinstance(mode, str):
         mode = int(mode)
 
-    if not os.path.exists(source):
-        raise ConvergeError(f"Template {source} does not exist!")
+    contents = _read_template(source).format_map(variables)
 
-    with open(source) as fr:
-        contents = fr.read()
+    if os.path.exists(dest):
+        with open(dest) as fr:
+            unchanged = fr.read() == contents
+        if unchanged:
+            # leave the file (and its mtime) alone so nothing watching it reloads
+            logging.info(f"{dest} is unchanged, skipping")
+        else:
+            shutil.move(dest, f"{dest}.backup")
+    else:
+        unchanged = False
 
-    with open(dest, "w") as fw:
-        fw.write(contents.format(**variables))
+    if not unchanged:
+        with open(dest, "w") as fw:
+            fw.write(contents)
 
     chmod(dest, mode)
     if owner and group:
         chown(dest, owner, group)
 
 
+def templates(entries: List[Tuple[str, Dict]]) -> None:
+    """
+    Renders independent templates concurrently. Each entry is
+    (dest, template() kwargs), see directories
+    """
+    _concurrently(lambda t: template(t[0], **t[1]), entries)
+
+
 def group(group_name: str, gid: Optional[int]) -> None:
-    groups = dict([(g.gr_name, g.gr_gid) for g in grp.getgrall()])
-    if group_name in groups:
-        # group already exists
-        # TODO logging
+    if _exists(getgrnam, group_name):
+        logging.debug(f"Group {group_name} already exists")
         return
     if gid is not None:
         cmd = ["groupadd", "-g", str(gid), group_name]
     else:
         cmd = ["groupadd", group_name]
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 def group_members(group_name: str, members: List[str], append: bool = True) -> None:
     assert append
+    # not the memoized getgrnam - membership is exactly what changes here
+    current = set(grp.getgrnam(group_name).gr_mem)
     for member in members:
-        subprocess.check_call(["usermod", "-a", "-G", group_name, member])
+        if member in current:
+            logging.debug(f"{member} is already a member of {group_name}")
+            continue
+        _check_call(["usermod", "-a", "-G", group_name, member])
 
 
 def user(
@@ -253,8 +455,7 @@ def user(
     uid: Optional[int] = None,
     gid: Optional[int] = None,
 ) -> None:
-    users = dict([(p.pw_name, p.pw_uid) for p in pwd.getpwall()])
-    if user_name in users:
+    if _exists(getpwnam, user_name):
         return
     logging.info(comment)
     cmd = ["useradd"]
@@ -264,7 +465,7 @@ def user(
         cmd += ["-g", str(gid)]
     if shell:
         cmd += ["-s", shell]
-    subprocess.check_call(cmd + [user_name])
+    _check_call(cmd + [user_name])
 
 
 class guard:
@@ -302,6 +503,14 @@ def directory(
     chmod(path, mode, recursive)
 
 
+def directories(dirs: List[Tuple[str, Dict]]) -> None:
+    """
+    Creates independent directories concurrently. Each entry is
+    (path, directory() kwargs) - none may depend on another.
+    """
+    _concurrently(lambda d: directory(d[0], **d[1]), dirs)
+
+
 def create_service(
     name: str,
     exec_start: str,
@@ -321,14 +530,32 @@ Restart=always
 
 [Install]
 WantedBy=multi-user.target"""
-    with open(f"/etc/systemd/system/{name}.service", "w") as fw:
-        fw.write(service_desc)
+    path = f"/etc/systemd/system/{name}.service"
+    if os.path.exists(path):
+        with open(path) as fr:
+            if fr.read() == service_desc:
+                logging.info(f"{path} is unchanged, skipping")
+                return
+    # atomic, so systemd never reads a partially written unit
+    file(path, content=service_desc)
 
 
 def enable_service(name: str) -> None:
     execute(f"enable service {name}", command=["systemctl", "enable", name])
 
 
+def enable_services(names: List[str]) -> None:
+    """
+    Enables all of the services with one systemctl call (and one reload)
+    """
+    if not names:
+        return
+    execute(
+        f"enable services {' '.join(names)}",
+        command=["systemctl", "enable"] + list(names),
+    )
+
+
 def start_service(name: str) -> None:
     execute(f"start service {name}", command=["systemctl", "start", name])
 
@@ -338,27 +565,28 @@ def restart_service(name: str) -> None:
 
 
 def cron(desc: str, minute: str, command: str) -> None:
-    temp_name = tempfile.NamedTemporaryFile(delete=False).name
-    try:
-        with open(temp_name, "w") as fw:
-            fw.write(f"# {desc}\n")
-            fw.write(f"{minute} * * * * {command}\n")
-        with open(temp_name) as fr:
-            logging.info("Adding crontab:")
-            logging.info(fr.read())
-        subprocess.check_call(["crontab", temp_name])
-    finally:
-        if os.path.exists(temp_name):
-            os.remove(temp_name)
+    crontab = f"# {desc}\n{minute} * * * * {command}\n"
+    logging.info("Adding crontab:")
+    logging.info(crontab)
+    # crontab - reads the new table from stdin, no temp file required
+    subprocess.run(
+        ["crontab", "-"], input=crontab.encode(), check=True, close_fds=False
+    )
 
 
 def _merge_dict(a: Dict, b: Dict) -> Dict:
-    for akey, avalue in a.items():
-        if isinstance(avalue, dict):
-            bvalue = b.setdefault(akey, {})
-            _merge_dict(avalue, bvalue)
-        else:
-            b[akey] = avalue
+    """
+    Deep merges a into b, a wins. Uses an explicit stack rather than
+    recursing, as node json can be deeply nested.
+    """
+    stack = [(a, b)]
+    while stack:
+        src, dest = stack.pop()
+        for akey, avalue in src.items():
+            if isinstance(avalue, dict):
+                stack.append((avalue, dest.setdefault(akey, {})))
+            else:
+                dest[akey] = avalue
 
     return b
 
@@ -400,18 +628,21 @@ def execute(
     if stdout and os.path.exists(stdout):
         return
 
-    for attempt in range(min(0, retries) + 1):
+    for attempt in range(retries + 1):
         try:
-            stdout_content = subprocess.check_output(command)
+            stdout_content = _check_output(command)
             if stdout:
                 with open(stdout, "w") as fw:
                     fw.write(stdout_content.decode())
+            break
         except:
-            if retries and attempt < retries:
+            if attempt < retries:
+                # back off, with jitter so nodes retrying together spread out
+                delay = retry_delay * (2 ** attempt) + random.uniform(0, retry_delay)
                 logging.exception(
-                    f"Attempt {attempt + 1}. Sleeping {retry_delay} seconds"
+                    f"Attempt {attempt + 1}. Sleeping {delay:.1f} seconds"
                 )
-                sleep(retry_delay)
+                sleep(delay)
             else:
                 raise
     if guard_file:
@@ -427,24 +658,20 @@ def _waagent_service_name(platform_family: str) -> str:
     return waagent_service_name
 
 
+_MONITOR_HOSTNAME_OFF = re.compile(r"(?im)^[ \t]*provisioning\.monitorhostname=n[ \t]*$")
+
+
 def _ensure_monitoring(platform_family: str) -> None:
-    with open("/etc/waagent.conf") as fr:
-        lines = fr.readlines()
+    dest_waagent = "/etc/waagent.conf"
+    with open(dest_waagent) as fr:
+        contents = fr.read()
 
-    modified = False
-    for i in range(len(lines)):
-        line = lines[i].strip().lower()
-        if re.match("^provisioning.monitorhostname=n$", line):
-            lines[i] = "Provisioning.MonitorHostName=y\n"
-            modified = True
+    contents, modified = _MONITOR_HOSTNAME_OFF.subn(
+        "Provisioning.MonitorHostName=y", contents
+    )
 
     if modified:
-        dest_waagent = "/etc/waagent.conf"
-        temp_waagent = dest_waagent + ".tmp"
-        with open(temp_waagent, "w") as fw:
-            for line in lines:
-                fw.write(line)
-        move(temp_waagent, dest_waagent)
+        file(dest_waagent, content=contents)
         restart_service(_waagent_service_name(platform_family))
 
 
@@ -463,7 +690,7 @@ def _wait_for_hostname(hostname: str) -> None:
 
 def _unchecked_output(cmd: List[str]) -> str:
     try:
-        return subprocess.check_output(cmd).decode()
+        return _check_output(cmd).decode()
     except Exception as e:
         logging.debug(f"attempt to run {' '.join(cmd)} failed: {e}")
         return ""
@@ -476,13 +703,13 @@ def set_hostname(
         _ensure_monitoring(platform_family)
     pub_hostname_path = "/var/lib/waagent/published_hostname"
 
-    nslookup_stdout = _unchecked_output(["nslookup", hostname])
-    hostname_stdout = _unchecked_output(["hostname"])
-    pub_hostname_exists = os.path.exists(pub_hostname_path)
+    # cheapest checks first - nslookup is only forked when the other two
+    # can't already rule out re-registration. socket.gethostname() gives the
+    # same answer as /bin/hostname, without the fork+exec.
     if (
-        hostname not in nslookup_stdout
-        and hostname not in hostname_stdout
-        and pub_hostname_exists
+        os.path.exists(pub_hostname_path)
+        and hostname not in socket.gethostname()
+        and hostname not in _unchecked_output(["nslookup", hostname])
     ):
         os.remove(pub_hostname_path)
         logging.warning("Restarting waagent service to force re-registration of hostname")
@@ -1,33 +1,66 @@
 import configparser
 import os
+import shlex
+import shutil
 import subprocess
 import sys
 import tarfile
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 import slurm_supported_version
 
+# nearly all of the package is rpms/debs, which are already compressed -
+# higher levels burn CPU for practically no size reduction.
+COMPRESS_LEVEL = 1
+
 ## temporarily while our rpms/debs are not in PMC we have to download zip files
 ## from  github. We will have to modify this function to download binaries from
 ## PMC once they are there.
-def download_bins(slurm_required_bins: None) -> None:
+def download_bins(slurm_required_bins: Optional[List[str]] = None) -> None:
+    url_root = slurm_supported_version.CURRENT_DOWNLOAD_URL
+    if not slurm_required_bins:
+        slurm_required_bins = slurm_supported_version.get_required_packages()
+
+    if all(os.path.exists(pkg) for pkg in slurm_required_bins):
+        print("All slurm packages are already downloaded.")
+        return
+
+    # each zip holds every package for one distro/version, so fetch each zip
+    # once (if any of its packages are missing), all of them in parallel.
+    by_zipfile: Dict[str, List[str]] = {}
+    for pkg in slurm_required_bins:
+        by_zipfile.setdefault(pkg.split("/")[0], []).append(pkg)
+
     with open("download-slurm-pkgs.sh", "w") as fw:
         fw.write(f"""#!/usr/bin/env bash
 cd $(dirname $0)
-""")    
-
-        url_root = slurm_supported_version.CURRENT_DOWNLOAD_URL
-        if not slurm_required_bins:
-            slurm_required_bins = slurm_supported_version.get_required_packages()
-        for pkg in slurm_required_bins:
-                zipfile = pkg.split("/")[0]
-                fw.write(f"""
-if [ ! -e {pkg} ]; then
-    rm -rf {zipfile}.zip
-    rm -rf {zipfile}
-    wget -O {zipfile}.zip {url_root}/{zipfile}.zip
-    unzip {zipfile}.zip
+
+# the zips are all fetched at once, so back off (and honor 429/503) rather
+# than failing the whole run on GitHub rate limiting
+download_zip() {{
+    rm -rf $1.zip $1
+    wget --tries=5 --waitretry=10 --retry-on-http-error=429,503 \\
+        -O $1.zip {url_root}/$1.zip && {shlex.quote(sys.executable)} -m zipfile -e $1.zip .
+}}
+
+pids=""
+""")
+
+        for zipfile, pkgs in by_zipfile.items():
+            any_missing = " || ".join(f"[ ! -e {pkg} ]" for pkg in pkgs)
+            fw.write(f"""
+if {any_missing}; then
+    download_zip {zipfile} &
+    pids="$pids $!"
 fi
+""")
+
+        fw.write("""
+status=0
+for pid in $pids; do
+    wait $pid || status=1
+done
+exit $status
 """)
 
     print(
@@ -70,40 +103,76 @@ def execute() -> None:
     if not os.path.exists("dist"):
         os.makedirs("dist")
 
-    tf = tarfile.TarFile.gzopen(
-        f"dist/azure-slurm-install-pkg-{version}.tar.gz", "w"
-    )
-
-    def _add(name: str, path: Optional[str] = None, mode: Optional[int] = None) -> None:
+    dist_path = f"dist/azure-slurm-install-pkg-{version}.tar.gz"
+    pigz = shutil.which("pigz")
+    pigz_proc = None
+    if pigz:
+        # the slurm packages dominate the size, and gzip is single threaded.
+        # Stream the tar through pigz instead, which uses every core.
+        with open(dist_path, "wb") as fw:
+            pigz_proc = subprocess.Popen(
+                [pigz, f"-{COMPRESS_LEVEL}", "-c"], stdin=subprocess.PIPE, stdout=fw
+            )
+        tf = tarfile.open(fileobj=pigz_proc.stdin, mode="w|")
+    else:
+        tf = tarfile.TarFile.gzopen(dist_path, "w", compresslevel=COMPRESS_LEVEL)
+
+    def _add(
+        name: str,
+        path: Optional[str] = None,
+        mode: Optional[int] = None,
+        keep_mode: bool = False,
+    ) -> None:
         path = path or name
         tarinfo = tarfile.TarInfo(f"azure-slurm-install/{name}")
-        tarinfo.size = os.path.getsize(path)
-        tarinfo.mtime = int(os.path.getmtime(path))
-        if mode:
+        # one stat for size, mtime and (optionally) mode
+        st = os.stat(path)
+        tarinfo.size = st.st_size
+        tarinfo.mtime = int(st.st_mtime)
+        if keep_mode:
+            tarinfo.mode = st.st_mode & 0o7777
+        elif mode:
             tarinfo.mode = mode
 
-        with open(path, "rb") as fr:
+        # tarfile copies members in small chunks, so let the file object
+        # itself read ahead 1MB at a time
+        with open(path, "rb", buffering=1 << 20) as fr:
             tf.addfile(tarinfo, fr)
 
-    _add("install.sh", "install.sh", mode=os.stat("install.sh")[0])
-    _add("install_logging.conf", "conf/install_logging.conf")
-    _add("installlib.py", "installlib.py")
-    _add("install.py", "install.py")
-    _add("slurmel8.repo", "slurmel8.repo")
-    _add("slurmel9.repo", "slurmel9.repo")
-    _add("ubuntu.sh", "ubuntu.sh", 600)
-    _add("rhel.sh", "rhel.sh", 600)
-    _add("AzureCA.pem", "AzureCA.pem")
-    _add("suse.sh", "suse.sh", 600)
-    _add("start-services.sh", "start-services.sh", 555)
-
-    for fil in os.listdir("templates"):
-        if os.path.isfile(f"templates/{fil}"):
-            _add(f"templates/{fil}", f"templates/{fil}")
-
+    # (name, path, _add kwargs)
+    members: List[Tuple[str, str, Dict]] = [
+        ("install.sh", "install.sh", dict(keep_mode=True)),
+        ("install_logging.conf", "conf/install_logging.conf", {}),
+        ("installlib.py", "installlib.py", {}),
+        ("install.py", "install.py", {}),
+        ("slurmel8.repo", "slurmel8.repo", {}),
+        ("slurmel9.repo", "slurmel9.repo", {}),
+        ("ubuntu.sh", "ubuntu.sh", dict(mode=600)),
+        ("rhel.sh", "rhel.sh", dict(mode=600)),
+        ("AzureCA.pem", "AzureCA.pem", {}),
+        ("suse.sh", "suse.sh", dict(mode=600)),
+        ("start-services.sh", "start-services.sh", dict(mode=555)),
+    ]
+
+    with os.scandir("templates") as entries:
+        for entry in entries:
+            # is_file() uses the d_type from the listing, no extra stat
+            if entry.is_file():
+                members.append((entry.path, entry.path, {}))
 
     for binary in slurm_required_bins:
-            _add(f"{binary}", os.path.abspath(f"{binary}"))
+        members.append((binary, os.path.abspath(binary), {}))
+
+    # add in path order, so files from the same directory are read together
+    for name, path, kwargs in sorted(members, key=lambda m: os.path.abspath(m[1])):
+        _add(name, path, **kwargs)
+
+    tf.close()
+    if pigz_proc:
+        assert pigz_proc.stdin
+        pigz_proc.stdin.close()
+        if pigz_proc.wait() != 0:
+            raise subprocess.CalledProcessError(pigz_proc.returncode, pigz_proc.args)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 # test: ignore
 import os
+import sys
 from subprocess import check_call
 from typing import List
 
@@ -14,11 +15,9 @@ CWD = os.path.dirname(os.path.abspath(__file__))
 class PyTest(TestCommand):
     def finalize_options(self) -> None:
         TestCommand.finalize_options(self)
-        import os
 
         xml_out = os.path.join(".", "build", "test-results", "pytest.xml")
-        if not os.path.exists(os.path.dirname(xml_out)):
-            os.makedirs(os.path.dirname(xml_out))
+        os.makedirs(os.path.dirname(xml_out), exist_ok=True)
         # -s is needed so py.test doesn't mess with stdin/stdout
         self.test_args = ["-s", "test", "--junitxml=%s" % xml_out]
         # needed for older setuptools to actually run this as a test
@@ -26,7 +25,6 @@ class PyTest(TestCommand):
 
     def run_tests(self) -> None:
         # import here, cause outside the eggs aren't loaded
-        import sys
         import pytest
 
         # run the tests, then the format checks.
@@ -134,7 +132,7 @@ setup(
         "typing_extensions==3.7.4.3",
         "zipp==3.19.1"
     ],
-    tests_require=["pytest==3.2.3"],
+    tests_require=["pytest"],
     cmdclass={"test": PyTest, "format": Formatter, "types": TypeChecking},
     url="http://www.cyclecomputing.com",
     maintainer="Cycle Computing",
@@ -1,7 +1,9 @@
 import argparse
-from typing import Dict, List
+from typing import List, Tuple
 import configparser
+import functools
 import os
+import re
 
 
 SUPPORTED_VERSIONS = {
@@ -29,68 +31,85 @@ SUPPORTED_VERSIONS = {
 
 CURRENT_DOWNLOAD_URL = "https://github.com/Azure/cyclecloud-slurm/releases/download/2024-12-03-bins"
 
+# <repo>/project.ini, two levels up from this file
+_PROJECT_INI = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "project.ini",
+)
 
-def get_required_packages() -> Dict[str, List[str]]:
-    mydir = os.path.dirname(os.path.abspath(__file__))
-    pardir = os.path.dirname(os.path.dirname(mydir))
 
-    ini = configparser.ConfigParser()
+# the version out of each [Value="24.05.4-2"] in Config.Entries
+_CONFIG_ENTRY_VALUE = re.compile(r'\[[^=\]]+=\s*"?([^"\]]+)"?\s*\]')
 
-    ini.read(os.path.join(pardir, "project.ini"))
-    expr = ini.get("config slurm.version", "Config.Entries")
-    clean_expr = expr[expr.index("[") + 1 : expr.rindex("]")].replace('"', "")
 
-    toks = clean_expr.split(",")
-    referenced_versions = set()
-    for tok in toks:
-        _, _referenced_version = tok.strip("]").strip("[").split("=")
-        referenced_versions.add(_referenced_version)
+@functools.lru_cache(maxsize=None)
+def _load_ini(path: str) -> configparser.ConfigParser:
+    """
+    project.ini does not change while packaging, so parse it once per process
+    """
+    ini = configparser.ConfigParser()
+    ini.read(path)
+    return ini
+
+
+_DEB_PKGS = (
+    "slurm-smd",
+    "slurm-smd-dev",
+    "slurm-smd-client",
+    "slurm-smd-libnss-slurm",
+    "slurm-smd-slurmctld",
+    "slurm-smd-slurmdbd",
+    "slurm-smd-slurmd",
+    "slurm-smd-slurmrestd",
+    "slurm-smd-sview",
+    "slurm-smd-libslurm-perl",
+    "slurm-smd-libpam-slurm-adopt",
+)
+
+_RPM_PKGS = (
+    "slurm",
+    "slurm-devel",
+    "slurm-example-configs",
+    "slurm-slurmctld",
+    "slurm-slurmd",
+    "slurm-slurmdbd",
+    "slurm-libpmi",
+    "slurm-perlapi",
+    "slurm-torque",
+    "slurm-openlava",
+    "slurm-slurmrestd",
+    "slurm-pam_slurm",
+    "slurm-contribs",
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _package_paths() -> Tuple[str, ...]:
+    ret: List[str] = []
+    for slurm_version, ostype in SUPPORTED_VERSIONS.items():
+        ret.extend(
+            f"slurm-pkgs-{distro}/slurm-{slurm_version}/debs/{slurmpkg}_{slurm_version}_{pkg['arch']}.deb"
+            for distro, pkg in ostype["debian"].items()
+            for slurmpkg in _DEB_PKGS
+        )
+        ret.extend(
+            f"slurm-pkgs-{distro}/slurm-{slurm_version}/RPMS/{slurmpkg}-{slurm_version}.{pkg['platform_version']}.{pkg['arch']}.rpm"
+            for distro, pkg in ostype["rhel"].items()
+            for slurmpkg in _RPM_PKGS
+        )
+    return tuple(ret)
+
+
+def get_required_packages() -> List[str]:
+    ini = _load_ini(_PROJECT_INI)
+    expr = ini.get("config slurm.version", "Config.Entries")
+    referenced_versions = set(_CONFIG_ENTRY_VALUE.findall(expr))
 
     assert referenced_versions == set(
         SUPPORTED_VERSIONS.keys()
     ), f"Expected {referenced_versions} == {set(SUPPORTED_VERSIONS.keys())}"
 
-    ret = []
-    for slurm_version,ostype in SUPPORTED_VERSIONS.items():
-
-        for distro,pkg in ostype["debian"].items():
-            for slurmpkg in [
-                "slurm-smd",
-                "slurm-smd-dev",
-                "slurm-smd-client",
-                "slurm-smd-libnss-slurm",
-                "slurm-smd-slurmctld",
-                "slurm-smd-slurmdbd",
-                "slurm-smd-slurmd",
-                "slurm-smd-slurmrestd",
-                "slurm-smd-sview",
-                "slurm-smd-libslurm-perl",
-                "slurm-smd-libpam-slurm-adopt"
-            ]:
-                ret.append(
-                    f"slurm-pkgs-{distro}/slurm-{slurm_version}/debs/{slurmpkg}_{slurm_version}_{pkg['arch']}.deb"
-                )
-        for distro,pkg in ostype["rhel"].items():
-
-            for slurmpkg in [
-                "slurm",
-                "slurm-devel",
-                "slurm-example-configs",
-                "slurm-slurmctld",
-                "slurm-slurmd",
-                "slurm-slurmdbd",
-                "slurm-libpmi",
-                "slurm-perlapi",
-                "slurm-torque",
-                "slurm-openlava",
-                "slurm-slurmrestd",
-                "slurm-pam_slurm",
-                "slurm-contribs"
-            ]:
-                ret.append(
-                    f"slurm-pkgs-{distro}/slurm-{slurm_version}/RPMS/{slurmpkg}-{slurm_version}.{pkg['platform_version']}.{pkg['arch']}.rpm"
-                )
-    return ret
+    return list(_package_paths())
 
 
 def main() -> None:
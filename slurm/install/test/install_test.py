@@ -0,0 +1,96 @@
+import errno
+import grp
+import os
+import pwd
+import subprocess
+from pathlib import Path
+from typing import Any, Dict
+
+import install
+import pytest
+
+
+def test_inject_vm_size() -> None:
+    assert (
+        install._inject_vm_size("-Z Feature=dyn", "Standard_F2")
+        == "-Z Feature=Standard_F2,dyn"
+    )
+    assert (
+        install._inject_vm_size("-Z feature=dyn", "Standard_F2")
+        == "-Z Feature=Standard_F2,dyn"
+    )
+    # the documented form, quoted for slurmd's --conf
+    assert (
+        install._inject_vm_size('-Z --conf "Feature=dyn"', "Standard_F2")
+        == '-Z --conf "Feature=Standard_F2,dyn"'
+    )
+    assert install._inject_vm_size("-Z", "Standard_F2") == "-Z"
+
+
+def test_settings_without_accounting() -> None:
+    config: Dict[str, Any] = {
+        "cluster_name": "My Cluster",
+        "node_name": "scheduler",
+        "hostname": "scheduler",
+        "ipaddress": "10.0.0.4",
+        "slurm": {"version": "23.11"},
+        "azure": {"metadata": {"compute": {"vmSize": "Standard_F2"}}},
+    }
+    s = install.InstallSettings(config, "rhel", "scheduler")
+    assert not s.acct_enabled
+    assert s.acct_user is None
+    assert config["slurm"]["accounting"] == {}
+    assert "acccounting" not in config["slurm"]
+
+
+def test_run_installer_failure(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    script = tmp_path / "installer.sh"
+    script.write_text("#!/bin/bash\nprintf 'bad byte \\xff\\n'\necho \"args $@\"\nexit 3\n")
+    script.chmod(0o755)
+
+    class Settings:
+        slurmver = "23.11"
+        disable_pmc = False
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        install.run_installer(Settings(), str(script), "scheduler")  # type: ignore
+    assert e.value.returncode == 3
+    assert e.value.output == "bad byte \ufffd\nargs scheduler 23.11 False"
+    # still echoed for cluster-init's console log
+    assert "args scheduler 23.11 False" in capsys.readouterr().out
+
+
+def test_publish_munge_key_without_hardlinks(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def no_link(src: str, dst: str) -> None:
+        raise OSError(errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(install.os, "link", no_link)
+
+    class Settings:
+        config_dir = str(tmp_path)
+        munge_user = pwd.getpwuid(os.getuid()).pw_name
+        munge_grp = grp.getgrgid(os.getgid()).gr_name
+
+    install._publish_munge_key(Settings(), b"secret")  # type: ignore
+    assert (tmp_path / "munge.key").read_bytes() == b"secret"
+    assert not (tmp_path / ".munge.key.tmp").exists()
+
+    # an existing key is kept, and the tmp file is still cleaned up
+    install._publish_munge_key(Settings(), b"other")  # type: ignore
+    assert (tmp_path / "munge.key").read_bytes() == b"secret"
+    assert not (tmp_path / ".munge.key.tmp").exists()
+
+    # any other error propagates, without leaving the tmp file behind
+    def broken_link(src: str, dst: str) -> None:
+        raise OSError(errno.EIO, "Input/output error")
+
+    monkeypatch.setattr(install.os, "link", broken_link)
+    (tmp_path / "munge.key").unlink()
+    with pytest.raises(OSError):
+        install._publish_munge_key(Settings(), b"secret")  # type: ignore
+    assert not (tmp_path / "munge.key").exists()
+    assert not (tmp_path / ".munge.key.tmp").exists()
@@ -1,8 +1,12 @@
 from copy import deepcopy
 import installlib
 from installlib import CCNode
+import io
 import logging
-from typing import Dict
+import os
+from email.message import Message
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, Union
 import pytest
 
 
@@ -12,6 +16,18 @@ base_software_configuration = {
 }
 
 
+def _recorder(calls: List[List[str]], result: Any = None) -> Callable[..., Any]:
+    """
+    Stand-in for subprocess.check_call/check_output that records each command
+    """
+
+    def record(cmd: List[str], **kwargs: Any) -> Any:
+        calls.append(cmd)
+        return result
+
+    return record
+
+
 @pytest.fixture
 def mock_clock():
     yield installlib.use_mock_clock()
@@ -210,4 +226,311 @@ def test_await_node_hostname_nodename_as_hostname(mock_clock) -> None:
         software_configuration=soft_config,
     )
 
-    assert actual.to_dict() == expected.to_dict()
\ No newline at end of file
+    assert actual.to_dict() == expected.to_dict()
+
+
+def test_chmod(tmp_path: Path) -> None:
+    path = tmp_path / "somefile"
+    path.write_text("")
+    path.chmod(0o644)
+
+    installlib.chmod(str(path), 644)
+    installlib.chmod(str(path), "0644")
+    assert os.stat(path).st_mode & 0o7777 == 0o644
+
+    installlib.chmod(str(path), "0600")
+    assert os.stat(path).st_mode & 0o7777 == 0o600
+
+    top = tmp_path / "munge"
+    (top / "a").mkdir(parents=True)
+    (top / "a" / "key").write_text("")
+    (top / "link").symlink_to(path)
+    installlib.chmod(str(top), 700, recursive=True)
+    for p in [top, top / "a", top / "a" / "key"]:
+        assert os.stat(p).st_mode & 0o7777 == 0o700
+    # symlinks are not followed
+    assert os.stat(path).st_mode & 0o7777 == 0o600
+
+
+def test_link(tmp_path: Path) -> None:
+    src = str(tmp_path / "slurm.conf")
+    dst = str(tmp_path / "link.conf")
+
+    installlib.link(src, dst)
+    assert os.readlink(dst) == src
+    # existing links are left alone
+    installlib.link(src, dst)
+    assert os.readlink(dst) == src
+
+    not_a_link = tmp_path / "regular.conf"
+    not_a_link.write_text("")
+    with pytest.raises(FileExistsError):
+        installlib.link(src, str(not_a_link))
+
+
+def test_files(tmp_path: Path) -> None:
+    installlib.files(
+        [
+            (str(tmp_path / "azure.conf"), dict(content="", mode="0644")),
+            (str(tmp_path / "keep_alive.conf"), dict(content="# managed", mode="0600")),
+        ]
+    )
+    assert (tmp_path / "azure.conf").read_text() == ""
+    assert (tmp_path / "keep_alive.conf").read_text() == "# managed"
+    assert os.stat(tmp_path / "keep_alive.conf").st_mode & 0o7777 == 0o600
+
+
+def test_file_ignores_stale_tmp(tmp_path: Path) -> None:
+    dest = tmp_path / "slurmd"
+    # left behind by an interrupted run
+    (tmp_path / "slurmd.tmp").write_text("SLURMD_OPTIONS=-b\n")
+    installlib.file(str(dest), content="SLURMD_OPTIONS=-b -N node1", mode="0700")
+    assert dest.read_text() == "SLURMD_OPTIONS=-b -N node1"
+    assert not (tmp_path / "slurmd.tmp").exists()
+
+
+def test_enable_services(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[List[str]] = []
+    monkeypatch.setattr(installlib.subprocess, "check_output", _recorder(calls, b""))
+    installlib.enable_services([])
+    assert calls == []
+    installlib.enable_services(["slurmdbd", "slurmd"])
+    assert calls == [["systemctl", "enable", "slurmdbd", "slurmd"]]
+
+
+def test_download_retries(mock_clock: installlib.MockClock, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    attempts: List[str] = []
+
+    def failing_urlopen(url: str, timeout: int, context: Any) -> io.BytesIO:
+        attempts.append(url)
+        raise installlib.urllib.error.HTTPError(url, 503, "unavailable", Message(), None)
+
+    monkeypatch.setattr(installlib.urllib.request, "urlopen", failing_urlopen)
+    dest = str(tmp_path / "AzureCA.pem")
+    with pytest.raises(installlib.urllib.error.HTTPError):
+        installlib.download("https://example.com/AzureCA.pem", dest, retries=2)
+    assert len(attempts) == 3
+    assert mock_clock.now == 1000.0 + 1 + 2
+
+    def not_found_urlopen(url: str, timeout: int, context: Any) -> io.BytesIO:
+        attempts.append(url)
+        raise installlib.urllib.error.HTTPError(url, 404, "not found", Message(), None)
+
+    attempts.clear()
+    monkeypatch.setattr(installlib.urllib.request, "urlopen", not_found_urlopen)
+    with pytest.raises(installlib.urllib.error.HTTPError):
+        installlib.download("https://example.com/AzureCA.pem", dest, retries=2)
+    assert len(attempts) == 1
+    assert not os.path.exists(dest)
+
+    # 429 is throttling, so it is retried like a 5XX
+    def throttled_urlopen(url: str, timeout: int, context: Any) -> io.BytesIO:
+        attempts.append(url)
+        raise installlib.urllib.error.HTTPError(url, 429, "too many requests", Message(), None)
+
+    attempts.clear()
+    monkeypatch.setattr(installlib.urllib.request, "urlopen", throttled_urlopen)
+    with pytest.raises(installlib.urllib.error.HTTPError):
+        installlib.download("https://example.com/AzureCA.pem", dest, retries=2)
+    assert len(attempts) == 3
+
+
+def test_download_cleans_up_tmp(
+    mock_clock: installlib.MockClock, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    class DroppedConnection(io.BytesIO):
+        def read(self, *args: Any) -> bytes:
+            raise ConnectionResetError("connection reset")
+
+    monkeypatch.setattr(
+        installlib.urllib.request,
+        "urlopen",
+        lambda url, timeout, context: DroppedConnection(),
+    )
+    dest = str(tmp_path / "AzureCA.pem")
+    with pytest.raises(ConnectionResetError):
+        installlib.download("https://example.com/AzureCA.pem", dest, retries=1)
+    assert os.listdir(str(tmp_path)) == []
+
+    # local errors are not retried as if they were network failures
+    def no_replace(src: str, dst: str) -> None:
+        raise PermissionError(13, "Permission denied")
+
+    monkeypatch.setattr(
+        installlib.urllib.request,
+        "urlopen",
+        lambda url, timeout, context: io.BytesIO(b"-----BEGIN CERTIFICATE-----"),
+    )
+    monkeypatch.setattr(installlib.os, "replace", no_replace)
+    now = mock_clock.now
+    with pytest.raises(PermissionError):
+        installlib.download("https://example.com/AzureCA.pem", dest)
+    assert mock_clock.now == now
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_sets_mode(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(
+        installlib.urllib.request,
+        "urlopen",
+        lambda url, timeout, context: io.BytesIO(b"-----BEGIN CERTIFICATE-----"),
+    )
+    dest = tmp_path / "AzureCA.pem"
+    installlib.download("https://example.com/AzureCA.pem", str(dest), mode="0600")
+    assert dest.read_bytes() == b"-----BEGIN CERTIFICATE-----"
+    assert os.stat(dest).st_mode & 0o7777 == 0o600
+    assert not os.path.exists(str(dest) + ".tmp")
+
+
+def test_templates(tmp_path: Path) -> None:
+    (tmp_path / "a.template").write_text("a={a}")
+    (tmp_path / "b.template").write_text("b")
+    installlib.templates(
+        [
+            (
+                str(tmp_path / "a.conf"),
+                dict(source=str(tmp_path / "a.template"), owner=None, group=None,
+                     mode=644, variables={"a": 1}),
+            ),
+            (
+                str(tmp_path / "b.conf"),
+                dict(source=str(tmp_path / "b.template"), owner=None, group=None,
+                     mode=600),
+            ),
+        ]
+    )
+    assert (tmp_path / "a.conf").read_text() == "a=1"
+    assert (tmp_path / "b.conf").read_text() == "b"
+    assert os.stat(tmp_path / "b.conf").st_mode & 0o7777 == 0o600
+
+
+def test_template_skips_unchanged(tmp_path: Path) -> None:
+    source = tmp_path / "a.template"
+    source.write_text("a={a}")
+    dest = tmp_path / "a.conf"
+    kwargs: Dict[str, Any] = dict(source=str(source), owner=None, group=None, mode=644)
+
+    installlib.template(str(dest), variables={"a": 1}, **kwargs)
+    os.utime(dest, (0, 0))
+    installlib.template(str(dest), variables={"a": 1}, **kwargs)
+    assert os.stat(dest).st_mtime == 0
+    assert not (tmp_path / "a.conf.backup").exists()
+
+    installlib.template(str(dest), variables={"a": 2}, **kwargs)
+    assert dest.read_text() == "a=2"
+    assert (tmp_path / "a.conf.backup").read_text() == "a=1"
+
+
+def test_chown_recursive(tmp_path: Path) -> None:
+    if os.geteuid() != 0:
+        pytest.skip("chown requires root")
+    nobody = installlib.getpwnam("nobody")
+    top = tmp_path / "spool"
+    (top / "a" / "b").mkdir(parents=True)
+    (top / "a" / "b" / "state").write_text("")
+    (top / "link").symlink_to(tmp_path)
+
+    installlib.chown(str(top), owner="nobody", recursive=True)
+
+    for path in [top, top / "a", top / "a" / "b", top / "a" / "b" / "state"]:
+        st = os.stat(path)
+        assert (st.st_uid, st.st_gid) == (nobody.pw_uid, nobody.pw_gid)
+    assert os.lstat(top / "link").st_uid == nobody.pw_uid
+    # the link target is left alone
+    assert os.stat(tmp_path).st_uid == 0
+
+
+def test_user_and_group_exist(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[List[str]] = []
+    monkeypatch.setattr(installlib.subprocess, "check_call", _recorder(calls))
+    installlib.group("root", gid=0)
+    installlib.user("root", comment="already there")
+    assert calls == []
+
+    installlib.group("no-such-group-xyz", gid=4242)
+    installlib.user("no-such-user-xyz", comment="new", shell="/bin/false", uid=4242)
+    assert calls == [
+        ["groupadd", "-g", "4242", "no-such-group-xyz"],
+        ["useradd", "-u", "4242", "-s", "/bin/false", "no-such-user-xyz"],
+    ]
+
+
+def test_group_members(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[List[str]] = []
+    monkeypatch.setattr(installlib.subprocess, "check_call", _recorder(calls))
+    monkeypatch.setattr(
+        installlib.grp,
+        "getgrnam",
+        lambda name: installlib.grp.struct_group(("cyclecloud", "x", 4242, ["slurm"])),
+    )
+    installlib.group_members("cyclecloud", members=["slurm", "munge"])
+    assert calls == [["usermod", "-a", "-G", "cyclecloud", "munge"]]
+
+
+def test_cron(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[Tuple[List[str], bytes, bool]] = []
+
+    def run(cmd: List[str], input: bytes, **kwargs: Any) -> None:
+        calls.append((cmd, input, kwargs["check"]))
+
+    monkeypatch.setattr(installlib.subprocess, "run", run)
+    installlib.cron("return_to_idle", "*/5", "/opt/azurehpc/slurm/return_to_idle.sh")
+    assert calls == [
+        (
+            ["crontab", "-"],
+            b"# return_to_idle\n*/5 * * * * /opt/azurehpc/slurm/return_to_idle.sh\n",
+            True,
+        )
+    ]
+
+
+def test_execute_retries(mock_clock: installlib.MockClock, monkeypatch: pytest.MonkeyPatch) -> None:
+    results: List[Union[Exception, bytes]] = [
+        RuntimeError("busy"),
+        RuntimeError("busy"),
+        b"ok",
+    ]
+    calls: List[List[str]] = []
+
+    def check_output(cmd: List[str], **kwargs: Any) -> bytes:
+        calls.append(cmd)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(installlib.subprocess, "check_output", check_output)
+    installlib.execute("flaky", command=["true"], retries=3, retry_delay=1)
+    # stops at the first success
+    assert len(calls) == 3
+    # 1 + 2 seconds of backoff, plus up to 1 second of jitter each
+    assert 1000.0 + 3 <= mock_clock.now <= 1000.0 + 5
+
+    calls.clear()
+    results[:] = [RuntimeError("down")] * 2
+    with pytest.raises(RuntimeError):
+        installlib.execute("broken", command=["false"], retries=1, retry_delay=1)
+    assert len(calls) == 2
+
+
+def test_merge_dict() -> None:
+    defaults = {"slurm": {"user": {"name": "slurm", "uid": 11100}, "version": "23.11"}}
+    node = {"slurm": {"user": {"uid": 11200}, "accounting": {"enabled": True}}, "a": 1}
+    assert installlib._merge_dict(node, defaults) == {
+        "slurm": {
+            "user": {"name": "slurm", "uid": 11200},
+            "version": "23.11",
+            "accounting": {"enabled": True},
+        },
+        "a": 1,
+    }
+
+
+def test_monitor_hostname_regex() -> None:
+    contents = "Provisioning.Enabled=n\n  provisioning.MonitorHostName=n \n\nOS.X=y\n"
+    new_contents, modified = installlib._MONITOR_HOSTNAME_OFF.subn(
+        "Provisioning.MonitorHostName=y", contents
+    )
+    assert modified == 1
+    assert new_contents == "Provisioning.Enabled=n\nProvisioning.MonitorHostName=y\n\nOS.X=y\n"
+    assert installlib._MONITOR_HOSTNAME_OFF.subn("", new_contents)[1] == 0
@@ -25,17 +25,25 @@ def custom_chaos_mode(action: Callable) -> Callable:
     return wrapped
 
 
+# read once at import - enabling chaos mode requires restarting the process
+_CHAOS_PROBABILITY = float(os.getenv("AZURE_SLURM_CHAOS_MODE") or 0)
+_CHAOS_EXCEPTIONS = (RuntimeError, ValueError, ConnectionError)
+
+
+def _default_chaos_action() -> Any:
+    raise random.choice(_CHAOS_EXCEPTIONS)("Random failure")
+
+
 def chaos_mode(func: Callable, action: Optional[Callable] = None) -> Callable:
-    def default_action() -> Any:
-        raise random.choice(
-            [RuntimeError, ValueError, ConnectionError]
-        )("Random failure")
+    if _CHAOS_PROBABILITY <= 0:
+        # the normal case - leave func completely unwrapped
+        return func
 
-    action = action or default_action
+    chaos_action = action or _default_chaos_action
 
     def wrapped(*args: Any, **kwargs: Any) -> Any:
         if is_chaos_mode():
-            return action or default_action()
+            return chaos_action()
 
         return func(*args, **kwargs)
 
@@ -43,4 +51,4 @@ def chaos_mode(func: Callable, action: Optional[Callable] = None) -> Callable:
 
 
 def is_chaos_mode() -> bool:
-    return random.random() < float(os.getenv("AZURE_SLURM_CHAOS_MODE", 0))
+    return _CHAOS_PROBABILITY > 0 and random.random() < _CHAOS_PROBABILITY
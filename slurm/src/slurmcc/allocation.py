@@ -2,7 +2,8 @@
 # Licensed under the MIT License.
 #
 import logging
-from typing import Callable, Dict, List, Set, Tuple
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 from hpc.autoscale import util as hpcutil
 from hpc.autoscale import clock
@@ -17,18 +18,34 @@ from . import partition as partitionlib
 from . import util as slutil
 
 
+class _NameHook:
+    """
+    Node name hook that hands out the single name currently being allocated
+    """
+
+    def __init__(self) -> None:
+        self.name = ""
+
+    def __call__(self, bucket: NodeBucket, index: int) -> str:
+        if index != 1:
+            raise RuntimeError(f"Could not create node with name {self.name}. Perhaps the node already exists in a terminating state?")
+        return self.name
+
+
 def resume(
     config: Dict,
     node_mgr: NodeManager,
     node_list: List[str],
     partitions: List[partitionlib.Partition],
 ) -> BootupResult:
-    name_to_partition = {}
-    for partition in partitions:
-        for name in partition.all_nodes():
-            name_to_partition[name] = partition
-    
-    existing_nodes_by_name = hpcutil.partition(node_mgr.get_nodes(), lambda n: n.name)
+    name_to_partition = {
+        name: partition for partition in partitions for name in partition.all_nodes()
+    }
+
+    # only nodes that are not Deallocated block a resume
+    existing_node_names: Set[str] = {
+        n.name for n in node_mgr.get_nodes() if n.state != "Deallocated"
+    }
 
     nodes = []
     unknown_node_names = []
@@ -38,13 +55,12 @@ def resume(
 
     if unknown_node_names:
         raise AzureSlurmError("Unknown node name(s): %s" % ",".join(unknown_node_names))
-    
+
+    name_hook = _NameHook()
     for name in node_list:
-        if name in existing_nodes_by_name:
-            node = existing_nodes_by_name[name][0]
-            if node.state != "Deallocated":
-                logging.info(f"{name} already exists.")
-                continue
+        if name in existing_node_names:
+            logging.info(f"{name} already exists.")
+            continue
 
         if name not in name_to_partition:    
             raise AzureSlurmError(
@@ -53,11 +69,7 @@ def resume(
         partition = name_to_partition[name]
         bucket = partition.bucket_for_node(name)
 
-        def name_hook(bucket: NodeBucket, index: int) -> str:
-            if index != 1:
-                raise RuntimeError(f"Could not create node with name {name}. Perhaps the node already exists in a terminating state?")
-            return name
-
+        name_hook.name = name
         node_mgr.set_node_name_hook(name_hook)
         constraints = {"node.bucket_id": bucket.bucket_id, "exclusive": True}
         if partition.is_hpc:
@@ -104,6 +116,53 @@ def wait_for_nodes_to_terminate(
 
 
 
+def _update_nodes(
+    node_names: List[str],
+    per_node: Optional[Dict[str, List[str]]] = None,
+    **fields: str,
+) -> List[str]:
+    """
+    Update all of node_names with a single `scontrol update`. per_node values are
+    paired with node_names by position (NodeName=a,b NodeAddr=x,y), fields apply
+    to every node. slurm rejects the whole batch if any one node is bad, e.g. a
+    name it does not know, so on failure each node is retried on its own.
+    Returns the names that still could not be updated.
+    """
+    per_node_values = per_node or {}
+
+    def update_args(indices: List[int]) -> List[str]:
+        args = ["update", "NodeName=%s" % ",".join(node_names[i] for i in indices)]
+        for key, values in per_node_values.items():
+            args.append("%s=%s" % (key, ",".join(values[i] for i in indices)))
+        for key, value in fields.items():
+            args.append("%s=%s" % (key, value))
+        return args
+
+    if not node_names:
+        return []
+
+    try:
+        slutil.scontrol(update_args(list(range(len(node_names)))))
+        return []
+    except Exception:
+        if len(node_names) == 1:
+            logging.exception("Failed to update node %s", node_names[0])
+            return list(node_names)
+        logging.exception(
+            "Failed to update nodes %s together, retrying one at a time",
+            ",".join(node_names),
+        )
+
+    failed = []
+    for i, name in enumerate(node_names):
+        try:
+            slutil.scontrol(update_args([i]))
+        except Exception:
+            logging.exception("Failed to update node %s", name)
+            failed.append(name)
+    return failed
+
+
 class WaitForResume:
     def __init__(self) -> None:
         self.failed_node_names: Set[str] = set()
@@ -113,7 +172,8 @@ class WaitForResume:
         self, node_list: List[str], latest_nodes: List[Node]
     ) -> Tuple[Dict, List[Node]]:
         ready_nodes = []
-        states = {}
+        states: Dict = Counter()
+        unknown_states: Dict[str, int] = Counter()
 
         by_name = hpcutil.partition_single(latest_nodes, lambda node: node.name)
 
@@ -125,50 +185,49 @@ class WaitForResume:
 
         deleted_nodes = []
 
+        # scontrol updates are collected and issued once per batch below, see
+        # _update_nodes.
+        reset_addr_node_names: List[str] = []
+
+        ip_updates: List[Tuple[str, str]] = []
+
+        idle_node_names: List[str] = []
+
         for name in node_list:
             node = by_name.get(name)
             
             if not node:
                 deleted_nodes.append(node)
                 continue
-            is_dynamic = node.software_configuration.get("slurm", {}).get("dynamic_config")
+            slurm_config = node.software_configuration.get("slurm") or {}
+            is_dynamic = slurm_config.get("dynamic_config")
 
             relevant_nodes.append(node)
 
             state = node.state
 
             if state and state.lower() == "failed":
-                states["Failed"] = states.get("Failed", 0) + 1
+                states["Failed"] += 1
                 if name not in self.failed_node_names:
                     newly_failed_node_names.append(name)
                     if not is_dynamic:
-                        slutil.scontrol(["update", f"NodeName={name}", f"NodeAddr={name}", f"NodeHostName={name}"])
-                    self.failed_node_names.add(name)
+                        reset_addr_node_names.append(name)
 
                 continue
 
-            use_nodename_as_hostname = node.software_configuration.get("slurm", {}).get(
-                "use_nodename_as_hostname", False
-            )
+            use_nodename_as_hostname = slurm_config.get("use_nodename_as_hostname", False)
             if not use_nodename_as_hostname:
                 ip_already_set_key = (name, node.private_ip)
                 if node.private_ip and ip_already_set_key not in self.ip_already_set:
-                    slutil.scontrol(
-                        [
-                            "update",
-                            "NodeName=%s" % name,
-                            "NodeAddr=%s" % node.private_ip,
-                            "NodeHostName=%s" % node.private_ip,
-                        ]
-                    )
-                    self.ip_already_set.add(ip_already_set_key)
+                    ip_updates.append(ip_already_set_key)
 
             if name in self.failed_node_names:
                 recovered_node_names.add(name)
+                if not is_dynamic:
+                    idle_node_names.append(name)
 
             if node.target_state != "Started":
-                states["UNKNOWN"] = states.get("UNKNOWN", {})
-                states["UNKNOWN"][node.state] = states["UNKNOWN"].get(state, 0) + 1
+                unknown_states[node.state] += 1
                 continue
 
             if node.state == "Ready":
@@ -177,53 +236,61 @@ class WaitForResume:
                 else:
                     ready_nodes.append(node)
 
-            states[state] = states.get(state, 0) + 1
+            states[state] += 1
+
+        if unknown_states:
+            states["UNKNOWN"] = unknown_states
+
+        # nodes whose update failed are left out of our bookkeeping, so the
+        # update is re-attempted next iteration.
+        reset_failed = _update_nodes(
+            reset_addr_node_names,
+            {"NodeAddr": reset_addr_node_names, "NodeHostName": reset_addr_node_names},
+        )
+        self.failed_node_names.update(
+            n for n in newly_failed_node_names if n not in reset_failed
+        )
+
+        if ip_updates:
+            ips = [ip for _, ip in ip_updates]
+            ip_failed = _update_nodes(
+                [name for name, _ in ip_updates],
+                {"NodeAddr": ips, "NodeHostName": ips},
+            )
+            self.ip_already_set.update(
+                key for key in ip_updates if key[0] not in ip_failed
+            )
 
         if newly_failed_node_names:
-            failed_node_names_str = ",".join(self.failed_node_names)
-            try:
+            failed_node_names = sorted(self.failed_node_names)
+            logging.error(
+                "The following nodes failed to start: %s", ",".join(failed_node_names)
+            )
+            down_failed = _update_nodes(
+                failed_node_names, State="down", Reason="cyclecloud_node_failure"
+            )
+            if down_failed:
                 logging.error(
-                    "The following nodes failed to start: %s", failed_node_names_str
-                )
-                for failed_name in self.failed_node_names:
-                    slutil.scontrol(
-                        [
-                            "update",
-                            "NodeName=%s" % failed_name,
-                            "State=down",
-                            "Reason=cyclecloud_node_failure",
-                        ]
-                    )
-            except Exception:
-                logging.exception(
                     "Failed to mark the following nodes as down: %s. Will re-attempt next iteration.",
-                    failed_node_names_str,
+                    ",".join(down_failed),
                 )
 
         if recovered_node_names:
-            recovered_node_names_str = ",".join(recovered_node_names)
-            try:
-                for recovered_name in recovered_node_names:
-                    logging.error(
-                        "The following nodes have recovered from failure: %s",
-                        recovered_node_names_str,
-                    )
-                    if not is_dynamic:
-                        slutil.scontrol(
-                            [
-                                "update",
-                                "NodeName=%s" % recovered_name,
-                                "State=idle",
-                                "Reason=cyclecloud_node_recovery",
-                            ]
-                        )
-                    if recovered_name in self.failed_node_names:
-                        self.failed_node_names.remove(recovered_name)
-            except Exception:
-                logging.exception(
+            logging.error(
+                "The following nodes have recovered from failure: %s",
+                ",".join(recovered_node_names),
+            )
+            idle_failed = _update_nodes(
+                idle_node_names, State="idle", Reason="cyclecloud_node_recovery"
+            )
+            if idle_failed:
+                logging.error(
                     "Failed to mark the following nodes as recovered: %s. Will re-attempt next iteration.",
-                    recovered_node_names_str,
+                    ",".join(idle_failed),
                 )
+            self.failed_node_names.difference_update(
+                n for n in recovered_node_names if n not in idle_failed
+            )
 
         return (states, ready_nodes)
 
@@ -233,8 +300,11 @@ def wait_for_resume(
     operation_id: str,
     node_list: List[str],
     get_latest_nodes: Callable[[], List[Node]],
-    waiter: "WaitForResume" = WaitForResume(),
+    waiter: Optional["WaitForResume"] = None,
 ) -> None:
+    if waiter is None:
+        waiter = WaitForResume()
+
     previous_states = {}
 
     nodes_str = ",".join(node_list[:5])
@@ -279,19 +349,23 @@ def wait_for_resume(
         "The following nodes reached Ready state: %s",
         ",".join([x.name for x in ready_nodes]),
     )
-    for node in ready_nodes:
-        if not hpcutil.is_valid_hostname(config, node):
-            continue
-        is_dynamic = node.software_configuration.get("slurm", {}).get("dynamic_config")
-        if is_dynamic:
-            continue
-        slutil.scontrol(
-            [
-                "update",
-                "NodeName=%s" % node.name,
-                "NodeAddr=%s" % node.private_ip,
-                "NodeHostName=%s" % node.hostname,
-            ]
+    to_update = [
+        node
+        for node in ready_nodes
+        if hpcutil.is_valid_hostname(config, node)
+        and not (node.software_configuration.get("slurm") or {}).get("dynamic_config")
+    ]
+    update_failed = _update_nodes(
+        [node.name for node in to_update],
+        {
+            "NodeAddr": [str(node.private_ip) for node in to_update],
+            "NodeHostName": [str(node.hostname) for node in to_update],
+        },
+    )
+    if update_failed:
+        raise AzureSlurmError(
+            "Failed to update the IP address of the following nodes: %s"
+            % ",".join(update_failed)
         )
 
     logging.info(
@@ -167,3 +167,128 @@ def test_failure_mode() -> None:
     bindings.update_state("Failed", ["htc-1"])
     states, ready = waiter.check_nodes(node_list, get_latest_nodes())
     assert native_cli.slurm_nodes["htc-1"]["NodeAddr"] == "htc-1", states
+
+
+def _record_updates(native_cli: testutil.MockNativeSlurmCLI) -> List[List[str]]:
+    updates: List[List[str]] = []
+    scontrol = native_cli.scontrol
+
+    def recording_scontrol(args: List[str], retry: bool = True) -> str:
+        if args[0] == "update":
+            updates.append(args)
+        return scontrol(args, retry)
+
+    native_cli.scontrol = recording_scontrol  # type: ignore
+    return updates
+
+
+def test_batched_updates() -> None:
+    node_mgr = testutil.make_test_node_manager()
+    bindings: MockClusterBinding = node_mgr.cluster_bindings  # type: ignore
+    native_cli = testutil.make_native_cli()
+    native_cli.create_nodes(["mydynamic-1"], features=["dyn"])
+    node_list = ["htc-1", "htc-2", "mydynamic-1"]
+    partitions = fetch_partitions(node_mgr, include_dynamic=True)
+    allocation.resume(testutil.CONFIG, node_mgr, node_list, partitions)
+
+    def get_latest_nodes() -> List[Node]:
+        return testutil.refresh_test_node_manager(node_mgr).get_nodes()
+
+    waiter = MockWaiter()
+    updates = _record_updates(native_cli)
+
+    # one IP update for all three nodes
+    bindings.assign_ip(node_list)
+    waiter.check_nodes(node_list, get_latest_nodes())
+    assert len(updates) == 1
+    assert updates[0][1] == "NodeName=htc-1,htc-2,mydynamic-1"
+    for node in get_latest_nodes():
+        assert native_cli.slurm_nodes[node.name]["NodeAddr"] == node.private_ip
+        assert native_cli.slurm_nodes[node.name]["NodeHostName"] == node.private_ip
+
+    # one reset of the static nodes' addresses, then one down update for all
+    updates.clear()
+    bindings.update_state("Failed", node_list)
+    states, _ = waiter.check_nodes(node_list, get_latest_nodes())
+    assert states["Failed"] == 3
+    assert updates == [
+        [
+            "update",
+            "NodeName=htc-1,htc-2",
+            "NodeAddr=htc-1,htc-2",
+            "NodeHostName=htc-1,htc-2",
+        ],
+        [
+            "update",
+            "NodeName=htc-1,htc-2,mydynamic-1",
+            "State=down",
+            "Reason=cyclecloud_node_failure",
+        ],
+    ]
+    assert native_cli.slurm_nodes["htc-2"]["NodeAddr"] == "htc-2"
+    assert native_cli.slurm_nodes["mydynamic-1"]["NodeAddr"] != "mydynamic-1"
+    assert waiter.failed_node_names == set(node_list)
+
+    # only the static nodes are set back to idle, all three count as recovered
+    updates.clear()
+    bindings.update_state("Ready", node_list)
+    waiter.check_nodes(node_list, get_latest_nodes())
+    idle_updates = [u for u in updates if "State=idle" in u]
+    assert idle_updates == [
+        [
+            "update",
+            "NodeName=htc-1,htc-2",
+            "State=idle",
+            "Reason=cyclecloud_node_recovery",
+        ]
+    ]
+    assert native_cli.slurm_nodes["htc-1"]["State"] == "idle"
+    assert native_cli.slurm_nodes["htc-2"]["State"] == "idle"
+    assert native_cli.slurm_nodes["mydynamic-1"]["State"] == "down"
+    assert not waiter.failed_node_names
+
+
+def test_batched_update_falls_back_per_node() -> None:
+    node_mgr = testutil.make_test_node_manager()
+    bindings: MockClusterBinding = node_mgr.cluster_bindings  # type: ignore
+    native_cli = testutil.make_native_cli()
+    node_list = ["htc-1", "htc-2", "htc-3"]
+    allocation.resume(testutil.CONFIG, node_mgr, node_list, fetch_partitions(node_mgr))
+
+    def get_latest_nodes() -> List[Node]:
+        return testutil.refresh_test_node_manager(node_mgr).get_nodes()
+
+    # slurm does not know htc-2, so the batch is rejected as a whole
+    htc_2 = native_cli.slurm_nodes.pop("htc-2")
+    waiter = MockWaiter()
+    updates = _record_updates(native_cli)
+    bindings.assign_ip(node_list)
+    waiter.check_nodes(node_list, get_latest_nodes())
+    # the batch, then one update per node
+    assert len(updates) == 4
+    ips = {n.name: n.private_ip for n in get_latest_nodes()}
+    assert native_cli.slurm_nodes["htc-1"]["NodeAddr"] == ips["htc-1"]
+    assert native_cli.slurm_nodes["htc-3"]["NodeAddr"] == ips["htc-3"]
+    assert ("htc-2", ips["htc-2"]) not in waiter.ip_already_set
+
+    # htc-2 is retried on the next iteration, the others are not re-sent
+    native_cli.slurm_nodes["htc-2"] = htc_2
+    updates.clear()
+    waiter.check_nodes(node_list, get_latest_nodes())
+    assert updates == [
+        [
+            "update",
+            "NodeName=htc-2",
+            "NodeAddr=%s" % ips["htc-2"],
+            "NodeHostName=%s" % ips["htc-2"],
+        ]
+    ]
+    assert native_cli.slurm_nodes["htc-2"]["NodeAddr"] == ips["htc-2"]
+
+    # a failed node slurm does not know is reset again next iteration
+    native_cli.slurm_nodes.pop("htc-3")
+    updates.clear()
+    bindings.update_state("Failed", ["htc-1", "htc-3"])
+    waiter.check_nodes(node_list, get_latest_nodes())
+    assert waiter.failed_node_names == {"htc-1"}
+    assert native_cli.slurm_nodes["htc-1"]["State"] == "down"
@@ -98,10 +98,19 @@ class MockNativeSlurmCLI(NativeSlurmCLI):
         if args[0] == "update":
             entity, value = args[1].split("=")
             if entity == "NodeName":
-                slurm_node = self.slurm_nodes[value]
+                # like scontrol, NodeName=a,b NodeAddr=x,y pairs up by position
+                node_names = value.split(",")
+                # scontrol rejects the whole update if any one name is unknown
+                for node_name in node_names:
+                    if node_name not in self.slurm_nodes:
+                        raise RuntimeError(f"Invalid node name specified - {node_name}")
                 for expr in args[2:]:
                     key, value = expr.split("=")
-                    slurm_node[key] = value
+                    values = value.split(",")
+                    if len(values) != len(node_names):
+                        values = [value] * len(node_names)
+                    for node_name, node_value in zip(node_names, values):
+                        self.slurm_nodes[node_name][key] = node_value
             else:
                 raise RuntimeError(f"Unknown args {args}")
             return ""